@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# Command protocol shared by ncbot.py and ircbot.py: parsing a command line
+# once into a Command, checking its MAC and nonce, and dispatching it through
+# a table of handlers. Every command's arguments are declared in
+# COMMAND_SCHEMAS and validated in one place, so a new command only needs a
+# schema entry here and a handler in each bot.
+import time
+from collections import namedtuple
+
+from botauth import tag_version
+from metrics import registry
+
+
+# Arguments each command takes, by type name in ARGUMENT_TYPES
+COMMAND_SCHEMAS = {
+    "status": (),
+    "shutdown": (),
+    "attack": ("host_port",),
+    "move": ("host_port",),
+}
+
+# Lines from other bots relayed by the hub or channel, and the hub's greeting;
+# "-status@<nonce>" matches too
+REPORT_PREFIXES = ("-joined", "-attack", "-status", "-shutdown", "-move", "-hub", "The command")
+
+# "nonce mac name arg..." split once. Binary frames carry their arguments
+# already parsed, in `values`.
+Command = namedtuple("Command", ["nonce", "mac", "name", "args", "values"], defaults=(None,))
+
+# Outcomes of CommandGuard.check
+ACCEPTED = "accepted"
+OTHER_SCHEME = "other scheme"
+FORGED = "forged"
+REPLAYED = "replayed"
+
+# Metrics recorded on every command, looked up once
+commands_received = {name: registry.counter("bot_commands_total", command=name) for name in COMMAND_SCHEMAS}
+unknown_commands = registry.counter("bot_commands_total", command="unknown")
+auth_failures = registry.counter("bot_auth_failures_total")
+replay_rejections = registry.counter("bot_replay_rejections_total")
+mac_verify_seconds = registry.histogram("bot_mac_verify_seconds")
+dispatch_seconds = registry.histogram("bot_dispatch_seconds")
+
+
+class CommandError(Exception):
+    pass
+
+class UnknownCommand(CommandError):
+    def __init__(self, name):
+        super().__init__(f"The command '{name}' is not accepted.")
+
+# Worded like UnknownCommand, so the controller and other bots treat it as an error reply
+class InvalidArguments(CommandError):
+    def __init__(self, name, detail):
+        super().__init__(f"The command '{name}' has invalid arguments: {detail}")
+
+
+#Returns (host, port) from "host:port", or raises ValueError if it is malformed.
+def parse_host_port(value):
+    host, _, port = value.rpartition(":")
+    if not host or not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f"expected host:port, got {value!r}")
+    return host, int(port)
+
+ARGUMENT_TYPES = {"host_port": parse_host_port}
+
+
+#The command as the controller signed it: the name and arguments separated by
+#single spaces, whether it arrived as a text line or as a binary frame.
+def command_text(command):
+    if command.values is None:
+        return " ".join([command.name] + command.args)
+    return " ".join([command.name] + [f"{host}:{port}" for host, port in command.values])
+
+def is_report(line):
+    return line.startswith(REPORT_PREFIXES)
+
+#Splits a command line into a Command, or returns None if it has fewer than three fields.
+def parse_command(line):
+    parts = line.split()
+    if len(parts) < 3:
+        return None
+    return Command(parts[0], parts[1], parts[2], parts[3:])
+
+
+# Authenticates commands for one bot: the MAC under the bot's auth scheme,
+# then the nonce against its replay store. Forged nonces never reach the store.
+class CommandGuard:
+    __slots__ = ("authenticator", "version", "seen_nonces")
+
+    def __init__(self, authenticator, version, seen_nonces):
+        self.authenticator = authenticator
+        self.version = version
+        self.seen_nonces = seen_nonces
+
+    def check(self, command):
+        # Mixed fleets get one line per auth scheme: the ones signed for the other scheme are not ours
+        version = tag_version(command.mac)
+        if version and version != self.version:
+            return OTHER_SCHEME
+        started = time.perf_counter()
+        authentic = self.authenticator.verify(command.nonce, command.mac, self.version, command_text(command))
+        mac_verify_seconds.since(started)
+        if not authentic:
+            auth_failures.inc()
+            return FORGED
+        if not self.seen_nonces.accept(command.nonce):
+            replay_rejections.inc()
+            return REPLAYED
+        return ACCEPTED
+
+
+# Maps command names to handlers. A handler is called as
+# handler(*context, command, *arguments) with the arguments already parsed.
+class Dispatcher:
+    __slots__ = ("handlers",)
+
+    def __init__(self, handlers):
+        missing = set(COMMAND_SCHEMAS) - set(handlers)
+        if missing:
+            raise ValueError(f"no handler for {', '.join(sorted(missing))}")
+        self.handlers = handlers
+
+    def dispatch(self, command, *context):
+        schema = COMMAND_SCHEMAS.get(command.name)
+        if schema is None:
+            unknown_commands.inc()
+            raise UnknownCommand(command.name)
+        values = command.values
+        if values is None:
+            if len(command.args) != len(schema):
+                raise InvalidArguments(command.name, " ".join(command.args) or "none given")
+            try:
+                values = [ARGUMENT_TYPES[kind](value) for kind, value in zip(schema, command.args)]
+            except ValueError as e:
+                raise InvalidArguments(command.name, e)
+
+        commands_received[command.name].inc()
+        started = time.perf_counter()
+        self.handlers[command.name](*context, command, *values)
+        dispatch_seconds.since(started)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Logging for ncbot.py, ircbot.py and nccontrolller.py.
+#
+# Records go through the standard logging module into a queue, and a
+# background thread formats and writes them. A call site whose level is off
+# costs one level check; one that is on only enqueues the record. Busy
+# categories (logger names such as "ncbot.command") can be sampled so that
+# only one record in N is kept. Warnings and errors are never sampled out.
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+
+LEVELS = ("debug", "info", "warning", "error")
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+listener = None
+
+
+# Keeps one record in every `rate` per category
+class SampleFilter(logging.Filter):
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.counts = {}
+
+    def filter(self, record):
+        rate = self.rates.get(record.name)
+        if not rate or record.levelno >= logging.WARNING:
+            return True
+        count = self.counts.get(record.name, 0)
+        self.counts[record.name] = count + 1
+        return count % rate == 0
+
+
+# Leaves formatting to the writer thread instead of doing it on enqueue
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+#Parses "--log-sample ncbot.command=100" into ("ncbot.command", 100).
+def parse_sample(value):
+    name, _, rate = value.partition("=")
+    if not name or not rate.isdigit() or int(rate) < 1:
+        raise ValueError(f"expected CATEGORY=N, got {value!r}")
+    return name, int(rate)
+
+def add_logging_arguments(parser, default="info"):
+    parser.add_argument('--log-level', choices=LEVELS, default=default,
+                        help='Lowest level that is logged (default: %(default)s)')
+    parser.add_argument('--log-sample', metavar='CATEGORY=N', action='append', default=[], type=parse_sample,
+                        help='Log only one in N records of a category, e.g. ncbot.command=100 (repeatable)')
+
+#Routes all logging through the background writer. `stream` defaults to stdout.
+def setup_logging(level="info", samples=(), stream=None):
+    global listener
+    stop_logging()
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    handler.addFilter(SampleFilter(dict(samples)))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(logging.Formatter(FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, output)
+    listener.start()
+
+#Writes out everything still queued. Runs at exit, including after sys.exit().
+def stop_logging():
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
+
+atexit.register(stop_logging)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Compact binary framing, spoken alongside the text protocol by ncbot.py,
+# nccontrolller.py and nchub.py.
+#
+# A frame is a fixed header, the raw MAC tag, a small payload and a newline:
+#
+#   marker 0xFF | version | type | tag length | payload length (2 bytes)
+#   nonce seconds (4) | nonce microseconds (4) | nonce instance (4)
+#
+# 0xFF never starts a UTF-8 text line, so frames and text lines can share a
+# connection and readers tell them apart by their first byte. The trailing
+# newline makes a peer that does not speak framing drop a stray frame as an
+# unparseable line instead of gluing it to the next command. Commands carry
+# a verb code and binary arguments instead of "nonce mac verb host:port", and
+# reports a kind code, the nick and the detail text. Everything is unpacked
+# straight from memoryviews over the receive buffers.
+#
+# Framing is negotiated per connection: the hub greets each client with
+# "-hub frame=1", bots announce "frame=1" in their -joined line, and the
+# controller only sends frames to a hub whose greeting and bots all said so.
+# Bots answer in the framing the command came in, so old peers only ever see
+# text.
+import logging
+import re
+import struct
+
+from botcore import COMMAND_SCHEMAS, Command, parse_host_port
+
+
+MARKER = 0xFF
+FRAME_VERSION = 1
+# Capability field announced in -joined and in the hub greeting
+CAPABILITY = f"frame={FRAME_VERSION}"
+
+HEADER = struct.Struct("!BBBBHII4s")
+HOST_PORT_PORT = struct.Struct("!H")
+
+# Message types
+COMMAND = 1
+REPORT = 2
+ERROR = 3
+
+# Frames stay within one bot receive buffer (ncbot.MAX_LINE_LENGTH)
+MAX_FRAME_SIZE = 4096
+
+# Stable wire codes; 0 is a command sent as text inside the frame
+VERB_CODES = {"status": 1, "shutdown": 2, "attack": 3, "move": 4}
+VERBS = {code: verb for verb, code in VERB_CODES.items()}
+KIND_CODES = {"-joined": 1, "-status": 2, "-attack": 3, "-shutdown": 4, "-move": 5}
+KINDS = {code: kind for kind, code in KIND_CODES.items()}
+
+CANONICAL_NONCE = re.compile(r"(\d+)\.(\d{6})-([0-9a-f]{8})$")
+
+log = logging.getLogger("framing")
+
+
+#Message type of a complete frame, without decoding it.
+def frame_type(view):
+    return view[2]
+
+#Returns where the message starting at `start` ends in buffer[:end]: after the
+#payload for a frame, after the newline for a text line. None while it is incomplete.
+def message_end(buffer, start, end):
+    if buffer[start] == MARKER:
+        if end - start < HEADER.size:
+            return None
+        _, _, _, tag_length, length, _, _, _ = HEADER.unpack_from(buffer, start)
+        stop = start + HEADER.size + tag_length + length + 1
+        return stop if stop <= end else None
+    newline = buffer.find(b"\n", start, end)
+    return None if newline < 0 else newline + 1
+
+#Splits the complete messages off the front of `buffer`, a bytearray that keeps
+#the incomplete rest. Text lines come back as str, frames as whatever
+#`decode(view)` makes of them; malformed frames are skipped.
+def split_messages(buffer, decode):
+    messages = []
+    start = 0
+    end = len(buffer)
+    with memoryview(buffer) as view:
+        while start < end:
+            stop = message_end(buffer, start, end)
+            if stop is None:
+                break
+            if buffer[start] == MARKER:
+                try:
+                    messages.append(decode(view[start:stop]))
+                except ValueError as e:
+                    log.debug("Skipping malformed frame: %s", e)
+            else:
+                line = str(view[start:stop], "utf-8", "replace").strip()
+                if line:
+                    messages.append(line)
+            start = stop
+    del buffer[:start]
+    return messages
+
+
+def pack_frame(kind, nonce, tag, payload):
+    if nonce is None:
+        seconds, micros, instance = 0, 0, bytes(4)
+    else:
+        match = CANONICAL_NONCE.match(nonce)
+        if not match:
+            raise ValueError(f"nonce {nonce!r} has no binary form")
+        seconds, micros, instance = int(match.group(1)), int(match.group(2)), bytes.fromhex(match.group(3))
+    if HEADER.size + len(tag) + len(payload) + 1 > MAX_FRAME_SIZE:
+        raise ValueError("frame too large")
+    header = HEADER.pack(MARKER, FRAME_VERSION, kind, len(tag), len(payload), seconds, micros, instance)
+    return header + tag + payload + b"\n"
+
+#Returns (type, nonce, tag view, payload view) of a frame held in a memoryview.
+def unpack_frame(view):
+    marker, version, kind, tag_length, length, seconds, micros, instance = HEADER.unpack_from(view)
+    if marker != MARKER or version != FRAME_VERSION:
+        raise ValueError(f"unsupported frame version {version}")
+    tag_end = HEADER.size + tag_length
+    if tag_end + length + 1 != len(view) or view[-1] != 0x0A:
+        raise ValueError("frame length does not match its header")
+    nonce = f"{seconds}.{micros:06d}-{instance.hex()}" if seconds else None
+    return kind, nonce, view[HEADER.size:tag_end], view[tag_end:-1]
+
+def pack_text(value):
+    data = value.encode()
+    if len(data) > 255:
+        raise ValueError("field longer than 255 bytes")
+    return bytes((len(data),)) + data
+
+#Returns the length-prefixed string at `offset` and the offset after it.
+def unpack_text(view, offset):
+    end = offset + 1 + view[offset]
+    if end > len(view):
+        raise ValueError("truncated field")
+    return str(view[offset + 1:end], "utf-8"), end
+
+
+def pack_host_port(value):
+    host, port = parse_host_port(value)
+    if f"{host}:{port}" != value:
+        # v2 MACs cover the text, which the bot rebuilds from host and port
+        raise ValueError(f"{value!r} is not in canonical form")
+    return pack_text(host) + HOST_PORT_PORT.pack(port)
+
+def unpack_host_port(view, offset):
+    host, offset = unpack_text(view, offset)
+    if not host or offset + HOST_PORT_PORT.size > len(view):
+        raise ValueError("truncated host:port")
+    (port,) = HOST_PORT_PORT.unpack_from(view, offset)
+    if not port:
+        raise ValueError("port 0")
+    return (host, port), offset + HOST_PORT_PORT.size
+
+# Binary form of each argument type in botcore.ARGUMENT_TYPES
+ARGUMENT_CODECS = {"host_port": (pack_host_port, unpack_host_port)}
+
+
+#Encodes a signed command. Commands without a binary form for their arguments
+#travel as text inside the frame, so the bot answers them like a text line.
+def encode_command(nonce, mac, command):
+    name, *args = command.split()
+    schema = COMMAND_SCHEMAS.get(name)
+    try:
+        if schema is None or len(args) != len(schema):
+            raise ValueError
+        payload = bytes((VERB_CODES[name],)) + b"".join(
+            ARGUMENT_CODECS[kind][0](arg) for kind, arg in zip(schema, args))
+    except ValueError:
+        payload = b"\x00" + command.encode()
+    return pack_frame(COMMAND, nonce, bytes.fromhex(mac), payload)
+
+#Decodes a command frame into a botcore.Command whose `values` are already parsed.
+def decode_command(view):
+    kind, nonce, tag, payload = unpack_frame(view)
+    if kind != COMMAND or nonce is None or not payload:
+        raise ValueError("not a signed command")
+    mac = tag.hex()
+    name = VERBS.get(payload[0])
+    if name is None:
+        parts = str(payload[1:], "utf-8", "replace").split()
+        if not parts:
+            raise ValueError("empty command")
+        return Command(nonce, mac, parts[0], parts[1:])
+
+    values = []
+    offset = 1
+    for argument in COMMAND_SCHEMAS[name]:
+        value, offset = ARGUMENT_CODECS[argument][1](payload, offset)
+        values.append(value)
+    if offset != len(payload):
+        raise ValueError("trailing bytes after the arguments")
+    return Command(nonce, mac, name, [], values)
+
+def encode_report(kind, nonce, nick, detail=""):
+    return pack_frame(REPORT, nonce, b"", bytes((KIND_CODES[kind],)) + pack_text(nick) + detail.encode())
+
+def encode_error(nonce, message):
+    return pack_frame(ERROR, nonce, b"", message.encode())
+
+#Decodes a report or error frame into (kind, nonce, nick, detail), the fields
+#nccontrolller.parse_report gives for text; errors come back as kind "error"
+#with the message as detail.
+def decode_report(view):
+    kind, nonce, _, payload = unpack_frame(view)
+    if kind == ERROR:
+        return "error", nonce, None, str(payload, "utf-8", "replace")
+    if kind != REPORT or not payload or payload[0] not in KINDS:
+        raise ValueError("not a report")
+    nick, offset = unpack_text(payload, 1)
+    return KINDS[payload[0]], nonce, nick, str(payload[offset:], "utf-8", "replace")
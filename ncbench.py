@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# End-to-end benchmark for the NC stack. Starts nchub.py on loopback, brings
+# up a fleet of bots and drives it through the controller's own command loop
+# (a Fleet and run_command, with its quorum and grace handling), for several
+# fleet sizes. Results are JSON so runs from different versions can be compared.
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import ncbot
+import nccontrolller
+from botlog import setup_logging
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = "1,10,100,1000"
+DEFAULT_ROUNDS = 50
+DEFAULT_WARMUP = 3
+SECRET = "benchSecret"
+
+
+# BotSessions for the whole fleet on one ncbot.BotEngine in a background thread
+class InProcessFleet(threading.Thread):
+    def __init__(self, count, port, secret):
+        super().__init__(daemon=True)
+        self.engine = ncbot.BotEngine()
+        self.sessions = [ncbot.BotSession("127.0.0.1", port, f"sim{index}", secret) for index in range(count)]
+
+    def run(self):
+        for session in self.sessions:
+            self.engine.add(session)
+        self.engine.run()
+
+    def stop(self):
+        self.engine.stop()
+        self.join()
+        self.engine.close()
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def start_hub(port):
+    hub = subprocess.Popen([sys.executable, os.path.join(HERE, "nchub.py"), f"127.0.0.1:{port}"],
+                           stdout=subprocess.DEVNULL)
+    connect_controller(port, timeout=10).close()
+    return hub
+
+def stop_hub(hub):
+    hub.terminate()
+    hub.wait()
+
+#Connects to the hub, retrying quickly until it accepts or the timeout passes.
+def connect_controller(port, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return socket.create_connection(("127.0.0.1", port))
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.01)
+
+def start_process_bots(count, port):
+    return [subprocess.Popen([sys.executable, os.path.join(HERE, "ncbot.py"), f"127.0.0.1:{port}", f"bot{index}", SECRET],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            for index in range(count)]
+
+#A controller Fleet connected to the local hub, as nccontrolller.py builds it.
+def connect_fleet(port):
+    fleet = nccontrolller.Fleet([("127.0.0.1", port)], argparse.Namespace(irc=None, nick=None))
+    fleet.connect()
+    return fleet
+
+#Collection settings that wait for every one of `count` bots, without a grace period.
+def bench_settings(count, timeout):
+    settings = nccontrolller.default_settings()
+    settings.update({"timeout": timeout, "quorum": 1.0, "grace": 0, "expect": count})
+    return settings
+
+#Waits until the roster knows `count` bots; returns the seconds it took or None.
+#Bots that joined before the controller are learned from the hub's answer to "-hub joined".
+def wait_for_joins(fleet, count, timeout):
+    started = time.time()
+    deadline = started + timeout
+    while len(nccontrolller.roster) < count:
+        if time.time() >= deadline:
+            return None
+        nccontrolller.poll_fleet(fleet, {}, deadline=deadline)
+    return time.time() - started
+
+#Waits until all `count` bots were heard from after `since`; returns the seconds since then or None.
+#Used after a hub restart, while the Fleet reconnects in the background: the fleet is also
+#polled with status, since a bot's -joined can reach the hub before the controller is back.
+def wait_for_fleet(fleet, count, since, timeout):
+    settings = bench_settings(count, 0.5)
+    while time.time() - since < timeout:
+        nccontrolller.run_command(fleet, SECRET, "status", settings)
+        back = sum(1 for record in nccontrolller.roster.bots.values() if record.last_seen >= since)
+        if back >= count:
+            return time.time() - since
+    return None
+
+#Resident set size of a process in KiB, from /proc (Linux) or getrusage for ourselves.
+def rss_kib(pid=None):
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if pid is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return None
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def run_size(count, args):
+    port = free_port()
+    hub = start_hub(port)
+    rss_before = rss_kib()
+    controller = connect_fleet(port)
+
+    if args.mode == "process":
+        processes, fleet = start_process_bots(count, port), None
+    else:
+        processes, fleet = [], InProcessFleet(count, port, SECRET)
+        fleet.start()
+
+    result = {"bots": count, "mode": args.mode}
+    try:
+        join_time = wait_for_joins(controller, count, args.join_timeout)
+        result["join_seconds"] = None if join_time is None else round(join_time, 3)
+        if join_time is None:
+            result["error"] = "not every bot joined in time"
+            return result
+
+        settings = bench_settings(count, args.timeout)
+        latencies = []
+        replies = 0
+        collecting = 0.0
+        for round_number in range(args.warmup + args.rounds):
+            started = time.time()
+            command = nccontrolller.run_command(controller, SECRET, "status", settings)
+            elapsed = time.time() - started
+            if round_number >= args.warmup:
+                latencies.append(elapsed)
+                replies += len(command.responses)
+                collecting += elapsed
+
+        result["latency_ms"] = {name: round(percentile(latencies, fraction) * 1000, 3)
+                                for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))}
+        result["replies"] = replies
+        result["expected_replies"] = count * args.rounds
+        result["replies_per_second"] = round(replies / collecting, 1) if collecting else None
+
+        result["rss_kib"] = {"hub": rss_kib(hub.pid), "controller": rss_kib()}
+        if processes:
+            bot_rss = [rss for rss in (rss_kib(process.pid) for process in processes) if rss]
+            result["rss_kib"]["bot_mean"] = round(sum(bot_rss) / len(bot_rss)) if bot_rss else None
+            result["rss_kib"]["bot_max"] = max(bot_rss, default=None)
+        else:
+            # In-process bots share the benchmark process: report the growth per bot
+            result["rss_kib"]["bot_mean"] = round((rss_kib() - rss_before) / count, 1)
+
+        # Restart the hub and time how long the whole fleet, controller included, takes to come back
+        stop_hub(hub)
+        restarted = time.time()
+        hub = start_hub(port)
+        rejoined = wait_for_fleet(controller, count, restarted, args.join_timeout)
+        result["reconnect_seconds"] = None if rejoined is None else round(rejoined, 3)
+        if fleet:
+            # Attempt counts and per-bot downtime as seen by the bots themselves
+            result["reconnect"] = fleet.engine.policy.stats()
+        return result
+    finally:
+        controller.close()
+        if fleet:
+            fleet.stop()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        stop_hub(hub)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='End-to-end latency and throughput benchmark for the NC stack.')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Comma separated fleet sizes (default: %(default)s)')
+    parser.add_argument('--mode', choices=['inproc', 'process'], default='inproc',
+                        help='All bots on one ncbot.BotEngine inside this process, or one ncbot.py process per bot')
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS, help='Measured status rounds per size')
+    parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP, help='Unmeasured rounds before measuring')
+    parser.add_argument('--timeout', type=float, default=nccontrolller.DEFAULT_TIMEOUT,
+                        help='Reply collection timeout per round in seconds')
+    parser.add_argument('--join-timeout', type=float, default=60, help='Seconds to wait for the fleet to join')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    # The in-process bots log their reconnects; only errors are of interest here
+    setup_logging("error", stream=sys.stderr)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "rounds": args.rounds,
+        "results": [],
+    }
+    for count in (int(size) for size in args.sizes.split(",")):
+        print(f"Benchmarking {count} bots ({args.mode})...", file=sys.stderr)
+        nccontrolller.roster.bots.clear()
+        report["results"].append(run_size(count, args))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -1,253 +1,665 @@
 #!/usr/bin/env python3
-import sys
+import argparse
+import errno
+import heapq
+import itertools
+import logging
+import os
+import selectors
 import socket
 import time
-import hashlib
-import select
-from socket import gaierror, timeout
+from nonce_store import NonceStore, DEFAULT_WINDOW
+from botauth import AUTH_V1, AUTH_VERSIONS, authenticator_for
+from botcore import (ACCEPTED, COMMAND_SCHEMAS, OTHER_SCHEME, CommandGuard, Dispatcher, InvalidArguments,
+                     UnknownCommand, command_text, is_report, parse_command)
+from reconnect import ReconnectPolicy, Resolver, add_reconnect_arguments, policy_from_args, resolver_from_args
+from metrics import registry, add_metrics_arguments, start_metrics
+from heartbeat import (DEAD, PING, PING_CAPABILITY, PING_LINE, HeartbeatPolicy, add_heartbeat_arguments,
+                       heartbeat_from_args)
+from framing import CAPABILITY, COMMAND, MARKER, decode_command, encode_error, encode_report, frame_type, message_end
+from botlog import add_logging_arguments, setup_logging
+import wirelog
 
 
-# Global variables for the current server
-current_hostname = None
-current_port = None
-sock = None  
+# Longest command line we are willing to buffer while waiting for its newline
+MAX_LINE_LENGTH = 4096
+# Seconds an attack connection may take before it is reported as failed
+ATTACK_TIMEOUT = 3
+# Seconds a half-closed connection waits for the hub to close its side
+LINGER_TIMEOUT = 2
+
+# Log categories; --log-sample can thin out each one separately
+log = logging.getLogger("ncbot")
+command_log = logging.getLogger("ncbot.command")
+auth_log = logging.getLogger("ncbot.auth")
+connection_log = logging.getLogger("ncbot.connection")
+
+# Metrics recorded on every read and write, looked up once; command metrics live in botcore
+bytes_received = registry.counter("bot_bytes_received_total")
+bytes_sent = registry.counter("bot_bytes_sent_total")
+reply_send_seconds = registry.histogram("bot_reply_send_seconds")
 
-def is_hostname_resolvable(hostname):
-    try:
-        socket.gethostbyname(hostname)
-        return True
-    except socket.gaierror:
-        return False
-    
 def parse_command_line_arguments():
     # Parse command line arguments to extract the server hostname, port, bot nickname, and secret.
-    if len(sys.argv) != 4:
-        print("Usage: ./ncbot.py <hostname:port> <nick> <secret>")
-        sys.exit(1)
-    hostname, port = sys.argv[1].split(":")
-    nick = sys.argv[2]
-    secret = sys.argv[3]
-    return hostname, int(port), nick, secret
-
-def connect_to_server(hostname, port):
-    # Attempt to connect to the specified server. Retry indefinitely on failure.
-    global sock
-    while True:
-        try:
-            new_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            new_sock.connect((hostname, port))
-            print("Connected.")
-            return new_sock
-        except socket.error as e:
-            print(f"Failed to connect. Reconnecting in 5s: {e}")
-            time.sleep(5)
-        
+    parser = argparse.ArgumentParser(description='NC bot that executes authenticated commands.')
+    parser.add_argument('server', help='Hostname and port of the server (hostname:port)')
+    parser.add_argument('nick', help='Nickname of this bot')
+    parser.add_argument('secret', help='Secret phrase for command authentication')
+    parser.add_argument('--nonce-window', type=int, default=DEFAULT_WINDOW,
+                        help='Seconds a nonce stays valid after it was issued (default: %(default)s)')
+    parser.add_argument('--nonce-file', help='File that keeps seen nonces across restarts')
+    parser.add_argument('--auth', choices=AUTH_VERSIONS, default=AUTH_V1,
+                        help='Command authentication scheme: v1 (sha256 prefix) or v2 (HMAC-SHA256) (default: %(default)s)')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='Number of bots to run in this process; nicks get a numeric suffix (default: %(default)s)')
+    add_reconnect_arguments(parser)
+    add_heartbeat_arguments(parser)
+    add_metrics_arguments(parser)
+    add_logging_arguments(parser)
+    wirelog.add_recording_arguments(parser)
+    args = parser.parse_args()
+    hostname, port = args.server.split(":")
+    return hostname, int(port), args.nick, args.secret, args
 
-#similar to python socket protocol
+#Sends as much of data as the non-blocking socket takes right now and returns the byte count.
 def send_data(sock, data):
-    total_sent = 0
-    while total_sent < len(data):
-        try:
-            sent = sock.send(data[total_sent:])
-            if sent == 0:
-                raise RuntimeError("socket connection broken")
-            total_sent += sent
-        except socket.error as e:
-            print(f"Send error: {e}")
-            raise
-#similar to python socket protocol
-def recv_data(sock, bufsize=1024):
     try:
-        data = sock.recv(bufsize)
-        if data == b'':
+        sent = sock.send(data)
+        bytes_sent.inc(sent)
+        if wirelog.recorder:
+            wirelog.recorder.record(wirelog.OUT, data[:sent], sock.fileno())
+        return sent
+    except BlockingIOError:
+        return 0
+    except socket.error as e:
+        connection_log.warning("Send error: %s", e)
+        raise
+
+#similar to python socket protocol, but fills the given buffer in place instead of allocating
+def recv_into_data(sock, view):
+    try:
+        received = sock.recv_into(view)
+        if received == 0:
             raise RuntimeError("socket connection broken")
-        return data
+        bytes_received.inc(received)
+        if wirelog.recorder:
+            wirelog.recorder.record(wirelog.IN, view[:received], sock.fileno())
+        return received
+    except BlockingIOError:
+        # Nothing to read yet: normal on a non-blocking socket, not worth a warning
+        raise
     except socket.error as e:
-        print(f"Receive error: {e}")
+        connection_log.warning("Receive error: %s", e)
         raise
 
+# Incremental newline framing on top of one reusable receive buffer.
+# Every complete line in a read is returned, a trailing partial line stays
+# in the buffer until the rest of it arrives with a later read. Binary frames
+# (see framing.py) come back as memoryviews into the buffer, which are only
+# valid until the next read.
+class LineReader:
+    __slots__ = ("buffer", "view", "start", "end", "discarding")
 
-def authenticate_command(nonce, secret, mac):
-    # Compute the MAC for the nonce+secret and compare it with the provided MAC.
-    expected_mac = hashlib.sha256(f"{nonce}{secret}".encode()).hexdigest()[:8]
-    return mac == expected_mac
+    def __init__(self, max_line_length=MAX_LINE_LENGTH):
+        self.buffer = bytearray(max_line_length)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        # Set while skipping the rest of a line that overflowed the buffer
+        self.discarding = False
 
-def attack(hostname, port, nick, nonce, bot_sock):
-    
-    report_message = ""
-    
-    # Check if the hostname is resolvable
-    if not is_hostname_resolvable(hostname):
-        report_message = f"-attack {nick} FAIL no such hostname\n"
-        send_data(bot_sock, report_message.encode())
-        return
+    def reset(self):
+        self.start = 0
+        self.end = 0
+        self.discarding = False
 
-    attack_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    attack_sock.setblocking(0)  
-    try:
-        attack_sock.connect((hostname, port))
-    except BlockingIOError:
-        pass  
+    #Moves a leftover partial line to the front so the next read has room.
+    def compact(self):
+        if self.start:
+            remaining = self.end - self.start
+            self.view[:remaining] = self.view[self.start:self.end]
+            self.start, self.end = 0, remaining
 
-    # Use select to monitor the socket for readiness to write or errors for up to 3 seconds
-    try:
-        _, ready_to_write, in_error = select.select([], [attack_sock], [attack_sock], 3)
-        if ready_to_write:
-            attack_msg = f"{nick} {nonce}\n".encode()
-            attack_sock.sendall(attack_msg)
-            report_message = f"-attack {nick} OK\n"
+    def read_lines(self, sock):
+        self.compact()
+        self.end += recv_into_data(sock, self.view[self.end:])
+        return self.split_lines()
+
+    #Frames bytes that did not come from a socket, e.g. a recorded log being replayed.
+    def feed(self, data):
+        lines = []
+        data = memoryview(data)
+        while data:
+            self.compact()
+            chunk = min(len(data), len(self.buffer) - self.end)
+            self.view[self.end:self.end + chunk] = data[:chunk]
+            self.end += chunk
+            data = data[chunk:]
+            # Frames are views into the buffer: copy them before the next compact() reuses it
+            lines += [line if isinstance(line, str) else bytes(line) for line in self.split_lines()]
+        return lines
+
+    def split_lines(self):
+        lines = []
+        while self.start < self.end:
+            if self.discarding:
+                newline = self.buffer.find(b"\n", self.start, self.end)
+                if newline < 0:
+                    break
+                self.discarding = False
+                self.start = newline + 1
+                continue
+            stop = message_end(self.buffer, self.start, self.end)
+            if stop is None:
+                break
+            if self.buffer[self.start] == MARKER:
+                lines.append(self.view[self.start:stop])
+            else:
+                line = str(self.view[self.start:stop], "utf-8", "replace").strip()
+                if line:
+                    lines.append(line)
+            self.start = stop
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.start == 0 and self.end == len(self.buffer):
+            # A full buffer without a newline: drop it and skip to the next newline
+            log.warning("Discarding line longer than %d bytes.", len(self.buffer))
+            self.discarding = True
+            self.start = self.end = 0
+        return lines
+
+
+# One bot: its identity, replay store, command counter and connection state.
+# A session turns received lines into replies and requested actions; all
+# socket work is done by BotEngine, so one process can host many sessions.
+# Replies go out in the framing their command came in.
+class BotSession:
+    __slots__ = ("nick", "secret", "authenticator", "auth_version", "hostname", "port", "seen_nonces", "guard",
+                 "command_count", "sock", "reader", "outbox", "writing", "closing", "move_target", "attacks",
+                 "backoff", "binary", "heartbeat", "hub_pings")
+
+    def __init__(self, hostname, port, nick, secret, seen_nonces=None, auth_version=AUTH_V1):
+        self.nick = nick
+        self.secret = secret
+        self.authenticator = authenticator_for(secret)
+        self.auth_version = auth_version
+        self.hostname = hostname
+        self.port = port
+        # Kept across reconnects so a command cannot be replayed after a reconnection
+        self.seen_nonces = seen_nonces if seen_nonces is not None else NonceStore()
+        self.guard = CommandGuard(self.authenticator, auth_version, self.seen_nonces)
+        self.command_count = 0
+        self.sock = None
+        self.reader = LineReader()
+        self.outbox = bytearray()
+        self.writing = False
+        # Set by shutdown: disconnect for good once the reply is sent
+        self.closing = False
+        # Set by move: (host, port) to reconnect to once the reply is sent
+        self.move_target = None
+        # Attacks requested by the lines just handled, started by the engine
+        self.attacks = []
+        # Reconnect state, given by the engine the session is added to
+        self.backoff = None
+        # Set while handling a command that arrived as a binary frame
+        self.binary = False
+        # Liveness of the connection, given by the engine; set when the hub answers pings
+        self.heartbeat = None
+        self.hub_pings = False
+
+    def send(self, message):
+        self.outbox += message.encode()
+
+    #Queues a report on a command, as a frame or as a "-kind@nonce nick detail" line.
+    def report(self, kind, nonce, detail="", binary=None):
+        if self.binary if binary is None else binary:
+            self.outbox += encode_report(f"-{kind}", nonce, self.nick, detail)
         else:
-            report_message = f"-attack {nick} FAIL Timeout or Unable to Connect\n"
-    except Exception as e:
-        report_message = f"-attack {nick} FAIL {str(e)}\n"
-    finally:
-        attack_sock.close()
-        send_data(bot_sock, report_message.encode())
+            self.send(f"-{kind}@{nonce} {self.nick} {detail}".rstrip() + "\n")
+
+    #Announcement sent on every connect with the bot's capabilities: binary
+    #framing, and for v2 bots their auth scheme.
+    def joined_message(self):
+        if self.auth_version == AUTH_V1:
+            return f"-joined {self.nick} {CAPABILITY}\n"
+        return f"-joined {self.nick} auth={self.auth_version} {CAPABILITY}\n"
+
+    #Handles one line or frame from the server. Returns False once the rest of
+    #the batch must be ignored because the bot is leaving this connection.
+    def handle_line(self, data):
+        if not isinstance(data, str):
+            return self.handle_frame(data)
+
+        # The hub greeting lists what the hub supports; its pongs need no handling
+        if data.startswith("-hub"):
+            if PING_CAPABILITY in data.split():
+                self.hub_pings = True
+            return True
+
+        # Check if the message is a system/join message and not a command.
+        if data.startswith("-joined"):
+            parts = data.split()
+            # Check if the join message is from another bot.
+            if len(parts) > 1 and parts[1] != self.nick:
+                log.debug("%s has joined.", parts[1])
+            return True
+
+        # Check if the message is a report from another bot if so skipped.
+        if is_report(data):
+            return True
+
+        #check the format of the responce from the server
+        command = parse_command(data)
+        if command is None:
+            auth_log.info("Invalid command format: %s", data)
+            return True
+        return self.handle_command(command)
+
+    #Handles a binary frame; reports other bots sent as frames are skipped like their lines.
+    def handle_frame(self, data):
+        if frame_type(data) != COMMAND:
+            return True
+        try:
+            command = decode_command(data)
+        except ValueError as e:
+            auth_log.info("Invalid command frame: %s", e)
+            return True
+        self.binary = True
+        try:
+            return self.handle_command(command)
+        finally:
+            self.binary = False
+
+    def handle_command(self, command):
+        outcome = self.guard.check(command)
+        if outcome == OTHER_SCHEME:
+            return True
+        if outcome != ACCEPTED:
+            auth_log.info("Invalid, expired or duplicate nonce detected: %s. Ignoring command.", command.nonce)
+            return True
+
+        # Execute recognized commands or reply to unrecognized ones
+        if command.name in COMMAND_SCHEMAS:
+            self.command_count += 1
+        self.execute_command(command)
+        return not (self.closing or self.move_target)
+
+    def execute_command(self, command):
+        command_log.debug("Executing command: %s, Args: %s", command.name, command.args or command.values)
+
+        # Debugging output for any command received, showing expected authentication info.
+        # Only computed when debug logging is on: it costs a second MAC per command.
+        if command.name not in ("status", "shutdown") and command_log.isEnabledFor(logging.DEBUG):
+            expected_mac = self.authenticator.sign(command.nonce, self.auth_version, command_text(command))
+            command_log.debug("Command: %s, Nonce: %s, Expected MAC: %s", command.name, command.nonce, expected_mac)
+
+        try:
+            self.dispatcher.dispatch(command, self)
+        except (UnknownCommand, InvalidArguments) as e:
+            # Answered either way, so the controller need not wait out its timeout
+            command_log.info("%s", e)
+            if self.binary:
+                self.outbox += encode_error(command.nonce, str(e))
+            else:
+                self.send(f"{e}\n")
+
+    # Command handlers. Reports carry the command nonce so the controller can match them to the command
+    def status(self, command):
+        self.report("status", command.nonce, str(self.command_count))
+
+    def shutdown(self, command):
+        self.report("shutdown", command.nonce)
+        self.closing = True
+
+    def attack(self, command, target):
+        self.attacks.append((target[0], target[1], command.nonce, self.binary))
+
+    def move(self, command, target):
+        self.report("move", command.nonce)
+        self.move_target = target
+
+    dispatcher = Dispatcher({"status": status, "shutdown": shutdown, "attack": attack, "move": move})
+
+
+# A non-blocking attack connection waiting for its result
+class Attack:
+    __slots__ = ("session", "sock", "nonce", "binary", "done")
+
+    def __init__(self, session, sock, nonce, binary=False):
+        self.session = session
+        self.sock = sock
+        self.nonce = nonce
+        # The command came as a frame, so the report goes out as one
+        self.binary = binary
+        self.done = False
+
+
+# Single-threaded driver multiplexing any number of BotSessions over one
+# selector. Reconnect retries, heartbeats and attack timeouts share one timer
+# heap, so a wakeup only looks at what is due instead of scanning every session.
+class BotEngine:
+    def __init__(self, policy=None, resolver=None, heartbeat=None):
+        # Shared by every session, so its counters cover the whole fleet
+        self.policy = policy or ReconnectPolicy()
+        self.resolver = resolver or Resolver()
+        self.heartbeat = heartbeat or HeartbeatPolicy()
+        self.selector = selectors.DefaultSelector()
+        self.sessions = set()
+        # Half-closed sockets waiting for the hub's end of the connection
+        self.lingering = set()
+        # (when, sequence, callback, argument); sequence keeps equal times ordered
+        self.timers = []
+        self.sequence = itertools.count()
+        self.running = False
+
+        # Lets stop() wake the loop from another thread
+        self.waker, self.wake_signal = socket.socketpair()
+        self.waker.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ, (None, None))
+
+    def add(self, session):
+        self.sessions.add(session)
+        session.backoff = self.policy.backoff()
+        session.heartbeat = self.heartbeat.monitor()
+        self.connect(session)
 
-#Handles moving the bot to a new server specified by the new_host and new_port arguments.    
-def move_to_new_server(new_host, new_port, nick, secret):
-    global current_hostname, current_port, sock
+    def call_later(self, delay, callback, argument):
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.sequence), callback, argument))
 
-    # Notify server of move, if the socket exists
-    if sock:
+    #Runs until every session has shut down or stop() is called.
+    def run(self):
+        self.running = True
+        while self.running and (self.sessions or self.lingering):
+            wait = max(self.timers[0][0] - time.monotonic(), 0) if self.timers else None
+            for key, events in self.selector.select(wait):
+                callback, argument = key.data
+                if callback is None:
+                    self.waker.recv(64)
+                else:
+                    callback(argument, events)
+
+            now = time.monotonic()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, callback, argument = heapq.heappop(self.timers)
+                callback(argument)
+
+    def stop(self):
+        self.running = False
         try:
-            send_data(sock, f"-move {nick}\n".encode())
-            sock.shutdown(socket.SHUT_RDWR)
+            self.wake_signal.send(b"x")
+        except OSError:
+            pass
+
+    def close(self):
+        for session in list(self.sessions):
+            self.disconnect(session)
+            session.seen_nonces.close()
+        self.sessions.clear()
+        for sock in list(self.lingering):
+            self.end_linger(sock)
+        for sock in (self.waker, self.wake_signal):
             sock.close()
+        self.selector.close()
+
+    def connect(self, session):
+        # A session that shut down while a retry was pending stays gone
+        if session not in self.sessions:
+            return
+        session.backoff.attempt()
+        address = self.resolver.resolve(session.hostname, session.port)
+        if address is None:
+            self.retry(session, f"cannot resolve {session.hostname}")
+            return
+        new_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        new_sock.setblocking(False)
+        self.heartbeat.configure(new_sock)
+        try:
+            error = new_sock.connect_ex(address)
         except socket.error as e:
-            print(f"Error closing old socket: {e}")
-    else:
-        print("No active socket to close.")
+            error = e
+        if error not in (0, errno.EINPROGRESS):
+            new_sock.close()
+            self.retry(session, error if isinstance(error, Exception) else os.strerror(error))
+            return
+        session.sock = new_sock
+        self.selector.register(new_sock, selectors.EVENT_WRITE, (self.finish_connect, session))
 
-    sock = None  # Reset the socket to trigger reconnection
-    current_hostname, current_port = new_host, new_port  # Fix the typo here
-   
+    def finish_connect(self, session, events):
+        error = session.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.disconnect(session)
+            self.retry(session, os.strerror(error))
+            return
+        down_for = session.backoff.connected()
+        if down_for is None:
+            connection_log.info("%s connected.", session.nick)
+        else:
+            connection_log.info("%s reconnected after %.2fs.", session.nick, down_for)
+        session.reader.reset()
+        session.outbox = bytearray(session.joined_message().encode())
+        session.writing = False
+        session.hub_pings = False
+        now = time.monotonic()
+        session.heartbeat.received(now)
+        wait = session.heartbeat.wait(now)
+        if wait is not None:
+            self.call_later(wait, self.check_heartbeat, (session, session.sock))
+        self.selector.modify(session.sock, selectors.EVENT_READ, (self.session_ready, session))
+        self.flush(session)
 
-def listen_for_commands(nick, secret):
-    global sock, current_hostname, current_port
-    seen_nonces = set()
-    command_count = 0
-    while True:
+    def retry(self, session, reason):
+        delay = session.backoff.next_delay()
+        connection_log.warning("Failed to connect. Reconnecting in %.2fs: %s", delay, reason)
+        self.call_later(delay, self.connect, session)
 
-        if not sock:
-            sock = connect_to_server(current_hostname, current_port)
-            send_data(sock, f"-joined {nick}\n".encode())
+    #Schedules a reconnect after losing an established connection. The short
+    #jittered wait spreads out a fleet that lost its hub at the same moment.
+    def reconnect(self, session):
+        self.disconnect(session)
+        self.call_later(session.backoff.next_delay(failed=False), self.connect, session)
 
+    #Pings a hub that has gone quiet and reconnects when the ping goes unanswered.
+    #`probe` is (session, socket): a timer left over from an earlier connection is ignored.
+    def check_heartbeat(self, probe):
+        session, sock = probe
+        if session.sock is not sock:
+            return
+        now = time.monotonic()
+        heartbeat = session.heartbeat
+        state = heartbeat.due(now)
+        if state == DEAD:
+            silent = heartbeat.missed(now)
+            connection_log.warning("%s: heartbeat unanswered after %.1fs of silence, reconnecting.", session.nick, silent)
+            self.reconnect(session)
+            return
+        if state == PING:
+            if session.hub_pings:
+                heartbeat.pinged(now)
+                session.outbox += PING_LINE
+                self.flush(session)
+                if session.sock is not sock:
+                    return
+            else:
+                # A hub that answers no pings is left to TCP keepalive
+                heartbeat.received(now)
+        self.call_later(heartbeat.wait(now), self.check_heartbeat, probe)
+
+    def disconnect(self, session, close=True):
+        if session.sock is None:
+            return
+        self.selector.unregister(session.sock)
+        if close:
+            session.sock.close()
+        session.sock = None
+        session.writing = False
+
+    def session_ready(self, session, events):
+        if events & selectors.EVENT_WRITE:
+            self.flush(session)
+        if events & selectors.EVENT_READ and session.sock is not None:
+            self.read(session)
+
+    def read(self, session):
         try:
-            data = recv_data(sock, 1024).decode().strip()
-            if not data:
-                print ("Server Disconected ")
-                sock = None
-                continue
+            lines = session.reader.read_lines(session.sock)
+        except BlockingIOError:
+            return
+        except (RuntimeError, socket.error) as e:
+            connection_log.warning("Error or disconnection detected: %s", e)
+            self.reconnect(session)
+            return
+        session.heartbeat.received(time.monotonic())
 
-            # Check if the message is a system/join message and not a command.
-            if data.startswith("-joined"):
-                joined_nick = data.split()[1]
-                # Check if the join message is from another bot.
-                if joined_nick != nick:  
-                    print(f"{joined_nick} has joined.")
-                continue  
-
-            # Check if the message is a report from an attack if so skipped.
-            if any(data.startswith(prefix) for prefix in ["-attack", "-status", "-shutdown", "-move"]):
-                
-                continue
-            
-            #check the format of the responce from the server
-            parts = data.split()
-            if len(parts) < 3:
-                print(f"Invalid command format: {data}")
-                continue
-            
-            #format of the command send by the server 
-            authenticate_nonce, mac, command, *args = parts
+        try:
+            for data in lines:
+                # A move or shutdown in this batch ends the connection the rest came from
+                if not session.handle_line(data):
+                    break
+            while session.attacks:
+                self.start_attack(session, *session.attacks.pop(0))
+        except Exception as e:
+            log.exception("Unexpected error, trying to reconnect: %s", e)
+            self.reconnect(session)
+            return
+        self.flush(session)
 
-            # Verify nonce uniqueness and command authenticity
-            if authenticate_nonce in seen_nonces or not authenticate_command(authenticate_nonce, secret, mac):
-                print(f"Invalid or duplicate nonce detected: {authenticate_nonce}. Ignoring command.")
-                continue
-            seen_nonces.add(authenticate_nonce)
+    #Writes queued replies; once they are all out, completes a pending shutdown or move.
+    def flush(self, session):
+        if session.sock is None:
+            return
+        try:
+            if session.outbox:
+                started = time.perf_counter()
+                del session.outbox[:send_data(session.sock, session.outbox)]
+                reply_send_seconds.since(started)
+        except socket.error:
+            self.reconnect(session)
+            return
 
-            # Execute recognized commands or print a message for unrecognized ones
-            if command in ["status", "shutdown", "move", "attack"]:
-                command_count += 1
-                execute_command(authenticate_nonce, command, args, sock, nick, command_count, secret)
-            else:
-                wrong_command = f"The command '{command}' is not accepted."
-                print(wrong_command)
-                send_data(sock, wrong_command.encode())
-        except RuntimeError as e:
-            print(f"Error or disconnection detected: {e}")
-            
-            # Reset the socket to trigger a reconnection attempt
-            sock = None  
-            break
-            
-
-def execute_command(authenticate_nonce ,command, args, sock, nick, command_count, secret):
-    print(f"Executing command: {command}, Args: {args}")
-
-    # Debugging output for any command received, showing expected authentication info
-    if command != "status" and command != "shutdown":
-        expected_mac = hashlib.sha256(f"{authenticate_nonce}{secret}".encode()).hexdigest()[:8]
-        print(f"Debug: Command: {command}, Nonce: {authenticate_nonce}, Expected MAC: {expected_mac}\n")
-    
-    if command == "status":
-        response = f"-status {nick} {command_count}\n"
-        send_data(sock, response.encode())
-        
-    elif command == "shutdown":
-        response = f"-shutdown {nick}\n"
-        send_data(sock, response.encode())
-        # Shutdown the socket for both reading and writing.
-        sock.shutdown(socket.SHUT_RDWR)  
-        sock.close()  
-        sys.exit(0)  
-    
-    elif command == "attack":
-        if len(args) == 1:
-            attack_hostname, attack_port = args[0].split(":")
-            attack(attack_hostname, int(attack_port), nick, authenticate_nonce, sock)
-        else:
-            print("Invalid arguments for the attack command.")
-    
-    elif command == "move":
-        if len(args) != 1:
-            print("Invalid move command format.")
+        if session.outbox:
+            if not session.writing:
+                session.writing = True
+                self.selector.modify(session.sock, selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                     (self.session_ready, session))
+            return
+        if session.writing:
+            session.writing = False
+            self.selector.modify(session.sock, selectors.EVENT_READ, (self.session_ready, session))
+
+        if session.closing:
+            self.half_close(session)
+            self.sessions.discard(session)
+            session.seen_nonces.close()
+        elif session.move_target:
+            session.hostname, session.port = session.move_target
+            session.move_target = None
+            self.half_close(session)
+            self.connect(session)
+
+    #Ends a connection once its last report is out: shuts down the sending side and
+    #reads until the hub closes too. Closing with unread input would send a reset,
+    #which can make the hub lose the report.
+    def half_close(self, session):
+        sock = session.sock
+        self.disconnect(session, close=False)
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except socket.error:
+            sock.close()
             return
-        new_host, new_port_str = args[0].split(":")
+        self.lingering.add(sock)
+        self.selector.register(sock, selectors.EVENT_READ, (self.drain, sock))
+        self.call_later(LINGER_TIMEOUT, self.end_linger, sock)
+
+    #Discards what a half-closed connection still receives, until the hub closes it.
+    def drain(self, sock, events):
         try:
-            new_port = int(new_port_str)
-            move_to_new_server(new_host, new_port, nick, secret)  
-        except ValueError:
-            print("Invalid port number provided for move command.")    
+            while sock.recv(65536):
+                pass
+        except BlockingIOError:
+            return
+        except socket.error:
+            pass
+        self.end_linger(sock)
 
-def main():
-    global current_hostname, current_port, sock
+    def end_linger(self, sock):
+        if sock not in self.lingering:
+            return
+        self.lingering.discard(sock)
+        self.selector.unregister(sock)
+        sock.close()
+
+    def start_attack(self, session, hostname, port, nonce, binary=False):
+        # Check if the hostname is resolvable
+        address = self.resolver.resolve(hostname, port)
+        if address is None:
+            session.report("attack", nonce, "FAIL no such hostname", binary)
+            return
 
-    current_hostname, current_port, nick, secret = parse_command_line_arguments()
+        attack_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        attack_sock.setblocking(0)
+        try:
+            attack_sock.connect_ex(address)
+        except socket.error as e:
+            attack_sock.close()
+            session.report("attack", nonce, f"FAIL {str(e)}", binary)
+            return
+
+        attack = Attack(session, attack_sock, nonce, binary)
+        self.selector.register(attack_sock, selectors.EVENT_WRITE, (self.finish_attack, attack))
+        self.call_later(ATTACK_TIMEOUT, self.expire_attack, attack)
 
-    while True:
+    def finish_attack(self, attack, events):
+        session = attack.session
+        error = attack.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
         try:
-            if not sock:
-                sock = connect_to_server(current_hostname, current_port)
-                send_data(sock, f"-joined {nick}\n".encode())
-            listen_for_commands(nick, secret)
-        except KeyboardInterrupt:
-            print("Program has been exited.")
-            break
+            if error:
+                raise OSError(error, os.strerror(error))
+            attack.sock.send(f"{session.nick} {attack.nonce}\n".encode())
+            report = "OK"
         except Exception as e:
-            print(f"Unexpected error, trying to reconnect: {e}")
-            if sock:
-                try:
-                    sock.close()
-                except Exception:
-                    pass 
-            # Reset sock to None to allow reconnection attempts     
-            sock = None  
-            time.sleep(5)
-
-        
+            report = f"FAIL {str(e)}"
+        self.end_attack(attack, report)
+
+    def expire_attack(self, attack):
+        if not attack.done:
+            self.end_attack(attack, "FAIL Timeout or Unable to Connect")
+
+    def end_attack(self, attack, report):
+        attack.done = True
+        self.selector.unregister(attack.sock)
+        attack.sock.close()
+        session = attack.session
+        session.report("attack", attack.nonce, report, attack.binary)
+        self.flush(session)
+
+
+def main():
+    hostname, port, nick, secret, options = parse_command_line_arguments()
+    setup_logging(options.log_level, options.log_sample)
+    if options.record:
+        wirelog.start_recording(options.record)
+
+    engine = BotEngine(policy_from_args(options), resolver_from_args(options), heartbeat_from_args(options))
+    registry.collect("bot_reconnect", engine.policy.stats)
+    registry.collect("bot_resolver", engine.resolver.stats)
+    start_metrics(options.metrics)
+    for index in range(options.sessions):
+        session_nick = nick if options.sessions == 1 else f"{nick}{index}"
+        nonce_file = options.nonce_file
+        if nonce_file and options.sessions > 1:
+            nonce_file = f"{nonce_file}.{session_nick}"
+        seen_nonces = NonceStore(window=options.nonce_window, path=nonce_file)
+        engine.add(BotSession(hostname, port, session_nick, secret, seen_nonces, options.auth))
+
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        log.info("Program has been exited.")
+    finally:
+        engine.close()
+
 
 if __name__ == "__main__":
     main()
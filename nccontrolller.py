@@ -1,178 +1,1306 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
+import errno
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import random
 import socket
 import sys
-import hashlib
 import time
 import select
+from collections import deque, namedtuple
+from nonce_store import generate_nonce
+from botauth import AUTH_V1, AUTH_VERSIONS, authenticator_for
+from metrics import registry, add_metrics_arguments, start_metrics
+from botlog import add_logging_arguments, setup_logging
+from framing import CAPABILITY, decode_report, encode_command, split_messages
+from ircproto import ERR_NOTREGISTERED, NICK_REJECTED, RPL_WELCOME, IrcParser
+from reconnect import ReconnectPolicy, Resolver, add_reconnect_arguments, policy_from_args, resolver_from_args
+from sendqueue import DEFAULT_INTERVAL, SendQueue, TokenBucket, add_flood_arguments, queue_from_args
+import wirelog
+
+log = logging.getLogger("controller")
 
 # Function to parse command line arguments
 def parse_arguments():
 
     parser = argparse.ArgumentParser(description='NC Controller for managing bots.')
     
-    parser.add_argument('server', help='Hostname and port of the server (hostname:port)')
+    parser.add_argument('server', help='Hostname and port of the server (hostname:port), or several hubs '
+                                       'separated by commas (host1:port,host2:port)')
     parser.add_argument('secret', help='Secret phrase for command authentication')
+    parser.add_argument('--auth', choices=('auto',) + AUTH_VERSIONS, default='auto',
+                        help='Auth scheme to sign with; auto signs for every scheme seen in the fleet (default: %(default)s)')
+    add_metrics_arguments(parser)
+    add_logging_arguments(parser)
+    wirelog.add_recording_arguments(parser)
+    parser.add_argument('--irc', metavar='CHANNEL',
+                        help='Speak IRC to the server and command the bots in CHANNEL, e.g. "#myChannel"')
+    parser.add_argument('--nick', help='Nick to register with --irc (default: a random ctl<number>)')
+    add_flood_arguments(parser)
+    add_reconnect_arguments(parser)
+    parser.add_argument('--schedule-jitter', type=float, default=DEFAULT_SCHEDULE_JITTER,
+                        help='Random delay of each "every" run, as a fraction of its interval, so controllers '
+                             'sharing a fleet do not fire together (default: %(default)s)')
+    parser.add_argument('--schedule-history', type=int, default=DEFAULT_SCHEDULE_HISTORY,
+                        help='Results kept per schedule (default: %(default)s)')
+    parser.add_argument('--batch', metavar='FILE',
+                        help='Run the commands in FILE ("-" for stdin) one after another and print one JSON object per command')
     # Parse the arguments
     args = parser.parse_args()
-    # Split the server argument into hostname and port
-    hostname, port = args.server.split(':')
+    # Split each hub into hostname and port
+    hubs = []
+    for server in args.server.split(','):
+        hostname, _, port = server.strip().rpartition(':')
+        if not hostname or not port.isdigit():
+            parser.error(f"expected hostname:port, got {server!r}")
+        hubs.append((hostname, int(port)))
     # Return the parsed values
-    return hostname, int(port), args.secret
+    return hubs, args.secret, args
 
-def compute_mac(nonce, secret):
-    message = f"{nonce}{secret}"
-    return hashlib.sha256(message.encode()).hexdigest()[:8]
+#`command` is covered by v2 MACs; pass it with single spaces, as bots rebuild it.
+def compute_mac(nonce, secret, version=AUTH_V1, command=""):
+    return authenticator_for(secret).sign(nonce, version, command)
 
-def send_data(sock, data):
-    total_sent = 0
-    # Loop until all data is sent
-    while total_sent < len(data):
-        try:
-            # Send the remaining data
-            sent = sock.send(data[total_sent:])
-            # If no data was sent, the connection is broken
-            if sent == 0:
-                raise RuntimeError("socket connection broken")
-            total_sent += sent
-        except socket.error as e:
-            # Print error and re-raise it for the caller to handle
-            print(f"Send error: {e}")
-            raise
-
-def recv_data(sock, bufsize=1024):
-    try:
-        # Attempt to receive data
-        data = sock.recv(bufsize)
-        # If no data is received, the connection is considered broken
-        if data == b'':
-            raise RuntimeError("socket connection broken")
-        return data
-    except socket.error as e:
-        # Print error and re-raise it for the caller to handle
-        print(f"Receive error: {e}")
-        raise
-
-def send_command(sock, command, secret):
-    #compute mac and nonce then send to server 
-    nonce = str(int(time.time()))
-    mac = compute_mac(nonce, secret)
-    full_command = f"{nonce} {mac} {command}\n"
-    send_data(sock, full_command.encode())
-
-def receive_responses(sock, timeout=5):
-    responses = []
-    sock.setblocking(0)
-
-    end_time = time.time() + timeout
-    while True:
-        now = time.time()
-        if now > end_time:
-            break
+#Counts bytes read from the hub and records them when a wire log is open.
+def record_received(sock, data):
+    bytes_received.inc(len(data))
+    if wirelog.recorder:
+        wirelog.recorder.record(wirelog.IN, data, sock.fileno())
+
+commands_sent = registry.counter("controller_commands_sent_total")
+frames_sent = registry.counter("controller_frames_sent_total")
+replies_received = registry.counter("controller_replies_total")
+unmatched_lines = registry.counter("controller_unmatched_lines_total")
+bytes_sent = registry.counter("controller_bytes_sent_total")
+bytes_received = registry.counter("controller_bytes_received_total")
+# From sending a command to printing its result
+command_seconds = registry.histogram("controller_command_seconds")
+
+# Reply prefix every bot sends back for each command
+REPLY_KINDS = {"status": "-status", "shutdown": "-shutdown", "attack": "-attack", "move": "-move"}
+
+DEFAULT_TIMEOUT = 5
+# Once this fraction of the expected bots has answered, stop after the grace period
+DEFAULT_QUORUM = 0.8
+DEFAULT_GRACE = 0.5
+
+# Roster entries older than this are shown as stale
+DEFAULT_STALE_AFTER = 60
+
+# What the controller knows about one bot
+class BotRecord:
+    __slots__ = ("nick", "first_seen", "last_seen", "command_count", "auth", "hub", "framing")
+
+    def __init__(self, nick, now):
+        self.nick = nick
+        self.first_seen = now
+        self.last_seen = now
+        # As last reported by the bot in a -status reply
+        self.command_count = None
+        # Auth scheme, from its -joined line or the signed command it answered
+        self.auth = None
+        # Hub it was last heard on
+        self.hub = None
+        # Whether its -joined line announced binary framing
+        self.framing = False
+
+# Bots believed to be on the hub, kept up to date from every line the
+# controller sees (solicited or not), so fleet questions need no round trip.
+class Roster:
+    __slots__ = ("bots", "schemes")
+
+    def __init__(self):
+        self.bots = {}
+        # Every auth scheme a bot used since we started, including bots since forgotten
+        self.schemes = set()
+
+    def __len__(self):
+        return len(self.bots)
+
+    def nicks(self):
+        return set(self.bots)
+
+    def observe(self, kind, nick, detail, now=None, hub=None):
+        if not nick or kind not in ("-joined", "-status", "-attack", "-move", "-shutdown"):
+            return
+        if kind in ("-move", "-shutdown"):
+            # The bot has left this hub
+            self.forget(nick)
+            return
+
+        now = time.time() if now is None else now
+        record = self.bots.get(nick)
+        if record is None:
+            record = self.bots[nick] = BotRecord(nick, now)
+        record.last_seen = now
+        record.hub = hub or record.hub
+        if kind == "-status" and detail.isdigit():
+            record.command_count = int(detail)
+        elif kind == "-joined":
+            # Bots announce capabilities as key=value fields; plain v1 bots announce none
+            fields = dict(field.partition("=")[::2] for field in detail.split())
+            record.auth = fields.get("auth", AUTH_V1)
+            self.schemes.add(record.auth)
+            record.framing = CAPABILITY in detail.split()
+
+    def forget(self, nick):
+        self.bots.pop(nick, None)
+
+    #Forgets every bot last heard on `hub`; returns their nicks.
+    def forget_hub(self, hub):
+        nicks = {nick for nick, record in self.bots.items() if record.hub == hub}
+        for nick in nicks:
+            del self.bots[nick]
+        return nicks
+
+    #Whether every bot known on `hub` announced binary framing; False if none is known.
+    def framed(self, hub):
+        records = [record for record in self.bots.values() if record.hub == hub]
+        return bool(records) and all(record.framing for record in records)
 
+    def learn_auth(self, nick, version):
+        record = self.bots.get(nick)
+        if record:
+            record.auth = version
+            self.schemes.add(version)
+
+    #Auth schemes a command has to be signed with to reach every bot. The roster
+    #may be behind: a bot that moved or rejoined is missing until it announces
+    #itself again. So the schemes of every bot seen so far are kept, along with
+    #v1, the bots' default, for bots not heard from yet.
+    def auth_versions(self):
+        known = {record.auth for record in self.bots.values()}
+        if not known or None in known:
+            return AUTH_VERSIONS
+        wanted = known | self.schemes | {AUTH_V1}
+        return tuple(version for version in AUTH_VERSIONS if version in wanted)
+
+    def show(self, stale_after=DEFAULT_STALE_AFTER, now=None):
+        now = time.time() if now is None else now
+        stale = sum(1 for record in self.bots.values() if now - record.last_seen > stale_after)
+        # Only worth showing when the fleet is spread over several hubs
+        several_hubs = len({record.hub for record in self.bots.values()}) > 1
+        print(f"\nRoster: {len(self.bots)} bots known ({len(self.bots) - stale} fresh, {stale} stale).")
+        for record in sorted(self.bots.values(), key=lambda record: record.nick):
+            age = now - record.last_seen
+            count = "?" if record.command_count is None else record.command_count
+            marker = " (stale)" if age > stale_after else ""
+            hub = f" on {record.hub}" if several_hubs else ""
+            print(f"{record.nick} {count} last seen {age:.1f}s ago{hub}{marker}")
+
+roster = Roster()
+
+#Splits a bot report into (kind, nonce, nick, detail). Older bots send untagged
+#reports ("-status nick 3"), newer ones tag the command nonce ("-status@<nonce> nick 3").
+def parse_report(line):
+    parts = line.split(maxsplit=2)
+    kind, _, nonce = parts[0].partition("@")
+    nick = parts[1] if len(parts) > 1 else None
+    detail = parts[2] if len(parts) > 2 else ""
+    return kind, nonce or None, nick, detail
+
+#A received text line as the (kind, nonce, nick, detail, line) that route_report takes.
+def text_report(line):
+    return parse_report(line) + (line,)
+
+#The same for a binary report frame; `line` is the text report it stands for.
+def frame_report(view):
+    kind, nonce, nick, detail = decode_report(view)
+    line = detail if kind == "error" else f"{kind} {nick} {detail}".rstrip()
+    return kind, nonce, nick, detail, line
+
+#Splits received bytes into lines, keeping an unfinished last line in `pending`.
+def split_lines(pending, data):
+    pending += data
+    *lines, rest = pending.split(b"\n")
+    pending[:] = rest
+    return [line.decode(errors="replace").strip() for line in lines if line.strip()]
+
+def random_nick():
+    return "ctl" + str(random.randint(1, 10000))
+
+# The raw line protocol relayed by nchub.py: one command or reply per line, or
+# per binary frame once the hub has greeted us with its framing capability.
+class NcTransport:
+    # Replies arrive as fast as the bots send them
+    pacing = 0
+    # Commands can be sent as soon as the connection is up
+    ready = True
+
+    def __init__(self, sock, outbound=None):
+        self.sock = sock
+        self.received = bytearray()
+        # Not flood limited: the queue only keeps a slow hub from blocking the loop
+        self.outbound = outbound or SendQueue(TokenBucket(interval=0))
+        # Set when the hub relays binary frames
+        self.framed = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    #Queues a signed command line; it goes out on the next flush.
+    def send(self, line):
+        self.outbound.put(f"{line}\n".encode())
+
+    def send_frame(self, frame):
+        self.outbound.put(frame)
+
+    def flush(self):
+        self.outbound.flush(self.send_available)
+
+    def send_available(self, view):
         try:
-            readable, _, _ = select.select([sock], [], [], max(end_time - now, 0))
-            if readable:
-                data = sock.recv(4096)
-                if data:
-                    responses.append(data.decode().strip())
+            sent = self.sock.send(view)
+        except BlockingIOError:
+            return 0
+        bytes_sent.inc(sent)
+        if wirelog.recorder:
+            wirelog.recorder.record(wirelog.OUT, view[:sent], self.sock.fileno())
+        return sent
+
+    def wants_write(self):
+        return self.outbound.wants_write()
+
+    def timeout(self):
+        return self.outbound.timeout()
+
+    #Reads what the socket has and returns the complete reports in it, as
+    #(kind, nonce, nick, detail, line) tuples.
+    def read_reports(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        record_received(self.sock, data)
+        return self.feed(data)
+
+    def feed(self, data):
+        self.received += data
+        reports = []
+        for message in split_messages(self.received, frame_report):
+            if not isinstance(message, str):
+                reports.append(message)
+            elif message.startswith("-hub"):
+                self.greeted(message)
             else:
-                # Break the loop if select returns no readable sockets before timeout
+                reports.append(text_report(message))
+        return reports
+
+    #The hub's greeting: a hub that relays frames is asked who is already on it,
+    #so the roster knows which bots take frames before the first command.
+    def greeted(self, line):
+        if CAPABILITY in line.split() and not self.framed:
+            self.framed = True
+            self.outbound.put(b"-hub joined\n")
+
+    def close(self):
+        self.sock.close()
+
+# IRC, as spoken by ircbot.py: commands go to the channel as PRIVMSGs through a
+# flood-controlled queue, and the bots' PRIVMSGs in the channel are the replies.
+class IrcTransport(NcTransport):
+    # The server paces every bot's lines, so replies can trickle in this far apart
+    pacing = DEFAULT_INTERVAL
+
+    def __init__(self, sock, channel, nick=None, outbound=None):
+        super().__init__(sock, outbound or SendQueue())
+        self.channel = channel if channel.startswith("#") else "#" + channel
+        self.nick = nick or random_nick()
+        self.parser = IrcParser()
+        # Set once the server welcomed us; commands wait for it
+        self.ready = False
+        # The server refused JOIN before registration completed (451)
+        self.join_refused = False
+
+    #Queues registration and the channel join in one write. feed() completes them
+    #as the server answers, so a slow server never blocks the other hubs.
+    def register(self):
+        self.send_raw(f"NICK {self.nick}")
+        self.send_raw(f"USER {self.nick} 0 * :{self.nick}")
+        self.send_raw(f"JOIN {self.channel}")
+
+    def send(self, line):
+        self.send_raw(f"PRIVMSG {self.channel} :{line}")
+
+    def send_raw(self, line):
+        self.outbound.put(f"{line}\r\n".encode())
+
+    def feed(self, data):
+        self.parser.feed(data)
+        reports = []
+        while self.parser.messages:
+            message = self.parser.messages.popleft()
+            nick = (message.prefix or "").partition("!")[0]
+            in_channel = bool(message.params) and message.params[0].lower() == self.channel.lower()
+            if message.command == "PING":
+                self.send_raw(f"PONG :{message.trailing or ' '.join(message.params)}")
+            elif message.command == "ERROR":
+                raise ConnectionError(message.trailing or "server sent ERROR")
+            elif message.command in NICK_REJECTED and not self.ready:
+                self.nick = random_nick()
+                log.info("Nickname rejected, retrying as %s", self.nick)
+                self.send_raw(f"NICK {self.nick}")
+            elif message.command == ERR_NOTREGISTERED:
+                self.join_refused = True
+            elif message.command == RPL_WELCOME:
+                # The server tells us the nick it registered us under
+                if message.params:
+                    self.nick = message.params[0]
+                if self.join_refused:
+                    self.send_raw(f"JOIN {self.channel}")
+                self.ready = True
+            elif message.command == "PRIVMSG" and in_channel and message.trailing:
+                reports.append(text_report(message.trailing.strip()))
+            elif message.command == "QUIT" or message.command == "PART" and in_channel:
+                # A bot that left the channel will not answer anything
+                roster.forget(nick)
+        return reports
+
+# Seconds a hub gets to accept the connection (and, over IRC, to register us)
+CONNECT_TIMEOUT = 5
+
+# One hub the controller keeps a connection to. `transport` is set once the
+# connection is made and the hub is up when the transport is ready; until then
+# the attempt is given up at `connect_deadline`. While the hub is down,
+# `retry_at` is when the next attempt starts.
+class HubLink:
+    __slots__ = ("name", "hostname", "port", "backoff", "sock", "transport", "connect_deadline", "retry_at", "error")
+
+    def __init__(self, hostname, port, backoff):
+        self.name = f"{hostname}:{port}"
+        self.hostname = hostname
+        self.port = port
+        self.backoff = backoff
+        # Set from the start of a connection attempt until the hub is lost
+        self.sock = None
+        self.transport = None
+        self.connect_deadline = None
+        self.retry_at = 0.0
+        # Why the hub is down
+        self.error = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def connecting(self):
+        return self.sock is not None and self.transport is None
+
+# Every hub the controller commands, served from one select loop. Each signed
+# line goes to all hubs that are up; a hub that is down or slow never holds up
+# the others and is reconnected with backoff in the background.
+class Fleet:
+    def __init__(self, hubs, options, policy=None, resolver=None):
+        self.policy = policy or ReconnectPolicy()
+        self.resolver = resolver or Resolver()
+        self.options = options
+        self.links = [HubLink(hostname, port, self.policy.backoff()) for hostname, port in hubs]
+        self.pacing = IrcTransport.pacing if options.irc else NcTransport.pacing
+        # (hub, report) pairs received while connect() waited, for the next poll()
+        self.held = []
+
+    def up(self):
+        return [link for link in self.links if link.transport and link.transport.ready]
+
+    #Hubs that are up or still registering.
+    def readers(self):
+        return [link for link in self.links if link.transport]
+
+    def writers(self):
+        return [link for link in self.links if link.connecting() or link.transport and link.transport.wants_write()]
+
+    #Seconds until a hub needs attention without a select event: queued lines, a connect
+    #attempt running out of time, or a retry coming due. None if nothing is waiting.
+    def timeout(self):
+        now = time.time()
+        waits = []
+        for link in self.links:
+            if link.transport:
+                waits.append(link.transport.timeout())
+                if not link.transport.ready:
+                    waits.append(link.connect_deadline - now)
+            elif link.sock:
+                waits.append(link.connect_deadline - now)
+            else:
+                waits.append(link.retry_at - now)
+        return min((max(wait, 0) for wait in waits if wait is not None), default=None)
+
+    #Sends a signed command to every hub that is up: as a binary frame where the
+    #hub and all the bots known on it announced framing, as a text line elsewhere.
+    def send(self, nonce, mac, command):
+        frame = None
+        for link in self.up():
+            transport = link.transport
+            if transport.framed and roster.framed(link.name):
+                if frame is None:
+                    try:
+                        frame = encode_command(nonce, mac, command)
+                    except ValueError:
+                        frame = b""
+                if frame:
+                    transport.send_frame(frame)
+                    frames_sent.inc()
+                    continue
+            transport.send(f"{nonce} {mac} {command}")
+
+    #Connects to every hub at once and waits up to CONNECT_TIMEOUT for them.
+    #Returns the hubs that are up; raises ConnectionError if none is.
+    def connect(self):
+        now = time.time()
+        for link in self.links:
+            self.start(link, now)
+        deadline = now + CONNECT_TIMEOUT
+        while True:
+            waiting = [link for link in self.links if link.sock and not (link.transport and link.transport.ready)]
+            wait = deadline - time.time()
+            if not waiting or wait <= 0:
                 break
-        except socket.error as e:
-            print(f"Receive error: {e}")
-            break
+            readable, writable, _ = select.select(self.readers(), self.writers(), [],
+                                                  min(wait, self.timeout() or wait))
+            reports, _ = self.poll(readable, writable)
+            self.held += reports
+        up = self.up()
+        if not up:
+            raise ConnectionError("; ".join(f"{link.name}: {link.error or 'connection timed out'}" for link in self.links))
+        return up
+
+    #Handles what select reported for the hubs, then starts due retries, expires slow
+    #connects and writes queued lines. Returns the (hub, report) pairs received and
+    #the nicks of bots on hubs that were lost, which can no longer answer.
+    def poll(self, readable=(), writable=()):
+        reports, self.held = self.held, []
+        gone = set()
+        now = time.time()
+        for link in self.links:
+            if link.sock is None:
+                if now >= link.retry_at:
+                    self.start(link, now)
+            elif link.transport is None:
+                if link in writable:
+                    self.finish(link)
+                elif now >= link.connect_deadline:
+                    self.lose(link, "connection timed out", failed=True)
+            else:
+                transport = link.transport
+                try:
+                    if link in readable:
+                        reports += [(link.name, report) for report in transport.read_reports()]
+                    transport.flush()
+                except OSError as e:
+                    gone |= self.lose(link, e)
+                    continue
+                if link.connect_deadline is None:
+                    continue
+                if transport.ready:
+                    self.came_up(link)
+                elif now >= link.connect_deadline:
+                    self.lose(link, "registration timed out", failed=True)
+        return reports, gone
+
+    def start(self, link, now):
+        link.backoff.attempt()
+        address = self.resolver.resolve(link.hostname, link.port)
+        if address is None:
+            self.lose(link, f"cannot resolve {link.hostname}", failed=True)
+            return
+        link.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        link.sock.setblocking(False)
+        link.connect_deadline = now + CONNECT_TIMEOUT
+        error = link.sock.connect_ex(address)
+        if error not in (0, errno.EINPROGRESS):
+            self.lose(link, os.strerror(error), failed=True)
+
+    def finish(self, link):
+        error = link.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.lose(link, os.strerror(error), failed=True)
+            return
+        if self.options.irc:
+            link.transport = IrcTransport(link.sock, self.options.irc, self.options.nick, queue_from_args(self.options))
+            link.transport.register()
+        else:
+            link.transport = NcTransport(link.sock)
+        try:
+            link.transport.flush()
+        except OSError as e:
+            self.lose(link, e, failed=True)
+            return
+        if link.transport.ready:
+            self.came_up(link)
+
+    #Marks a hub up once its transport is ready: connected and, over IRC, registered.
+    def came_up(self, link):
+        link.connect_deadline = None
+        link.error = None
+        if self.options.irc:
+            log.info("Joined %s on %s as %s.", link.transport.channel, link.name, link.transport.nick)
+        down_for = link.backoff.connected()
+        if down_for is not None:
+            log.info("Reconnected to %s after %.2fs.", link.name, down_for)
+
+    #Closes the hub's connection and schedules the next attempt; returns the nicks of its bots.
+    def lose(self, link, reason, failed=False):
+        if link.sock:
+            link.sock.close()
+        link.sock = link.transport = None
+        link.error = str(reason)
+        # Only the first failure in a row is a warning; the retries after it are routine
+        level = logging.WARNING if not link.backoff.failures else logging.INFO
+        delay = link.backoff.next_delay(failed)
+        link.retry_at = time.time() + delay
+        log.log(level, "Hub %s is down (%s); retrying in %.2fs.", link.name, reason, delay)
+        return roster.forget_hub(link.name)
+
+    def close(self):
+        for link in self.links:
+            if link.sock:
+                link.sock.close()
+            link.sock = link.transport = None
+
+    def stats(self):
+        return {"hubs": len(self.links), "up": len(self.up())}
+
+# One command in flight. Replies are collected until every expected bot has
+# answered, until `quorum` of them answered and `grace` seconds passed since,
+# or until the timeout. `expected` is a set of nicks, a bot count, or None to
+# simply wait for the timeout. An empty set, before any bot is known, ends once
+# replies have stopped arriving for the grace period. With `pacing`, every reply keeps collection
+# open for that many more seconds, so replies the server trickles out are not
+# cut off by a timeout meant for a fast hub.
+class PendingCommand:
+    __slots__ = ("command", "verb", "nonce", "versions", "reply_kind", "expected", "expected_count",
+                 "responders", "answered", "anonymous_replies", "responses", "aggregator",
+                 "sent_at", "timeout", "deadline", "quorum", "grace", "pacing", "hub_replies", "schedule")
+
+    def __init__(self, command, nonce, timeout=DEFAULT_TIMEOUT, expected=None,
+                 quorum=DEFAULT_QUORUM, grace=DEFAULT_GRACE, pacing=0):
+        self.command = command
+        self.verb = command.split()[0] if command else None
+        self.nonce = nonce
+        # Nonce of each line sent for this command and the auth scheme it was signed with
+        self.versions = {}
+        self.reply_kind = REPLY_KINDS.get(self.verb)
+        self.expected = expected
+        self.expected_count = len(expected) if isinstance(expected, (set, frozenset)) else expected
+        self.responders = set()
+        # Expected bots heard from so far, kept up to date as replies arrive
+        self.answered = 0
+        # Unknown-command errors carry no nick, so they are only counted
+        self.anonymous_replies = 0
+        self.responses = []
+        self.aggregator = ResponseAggregator(command)
+        self.sent_at = time.time()
+        self.timeout = timeout
+        self.deadline = self.sent_at + timeout
+        self.quorum = quorum
+        self.grace = grace
+        self.pacing = pacing
+        # Hub -> [replies received through it, seconds from sending to its latest reply]
+        self.hub_replies = {}
+        # The Schedule that started this command, if any
+        self.schedule = None
+
+    #True if an untagged line from an older bot can belong to this command.
+    def accepts_untagged(self, kind, nick, line):
+        if self.reply_kind and kind == self.reply_kind:
+            return nick not in self.responders
+        return line.startswith("The command") and f"'{self.verb}'" in line
+
+    def add(self, kind, nick, detail, line, hub=None):
+        now = time.time()
+        if hub:
+            replies = self.hub_replies.setdefault(hub, [0, None])
+            replies[0] += 1
+            replies[1] = now - self.sent_at
+        if self.reply_kind and kind == self.reply_kind:
+            if nick not in self.responders:
+                self.responders.add(nick)
+                if not isinstance(self.expected, (set, frozenset)) or nick in self.expected:
+                    self.answered += 1
+            # Summaries are built from the untagged form of the report
+            line = f"{kind} {nick} {detail}".rstrip()
+        elif "The command" in line:
+            self.anonymous_replies += 1
+        self.responses.append(line)
+        self.aggregator.add_line(line)
 
-    return responses
+        if self.pacing and self.deadline:
+            self.deadline = max(self.deadline, now + self.pacing)
+        self.check_answers(now)
 
+    #Stops waiting for bots that can no longer answer, such as those on a hub that went down.
+    def forget(self, nicks):
+        if not isinstance(self.expected, (set, frozenset)) or not self.expected & nicks:
+            return
+        self.expected = self.expected - (nicks - self.responders)
+        self.expected_count = len(self.expected)
+        if not self.expected_count:
+            # Everyone we knew of is gone: only give unknown bots the grace period
+            self.deadline = min(self.deadline, time.time() + self.grace)
+        self.check_answers(time.time())
 
+    def check_answers(self, now):
+        if not self.expected_count:
+            if self.expected is not None and (self.responders or self.anonymous_replies):
+                # No bot known to wait for: stop once the replies have dried up
+                limit = max(self.sent_at + self.timeout, now + self.pacing)
+                self.deadline = min(now + max(self.grace, self.pacing), limit)
+            return
+        answered = self.answered + self.anonymous_replies
+        if answered >= self.expected_count:
+            self.deadline = 0
+        elif answered >= self.quorum * self.expected_count:
+            # Quorum reached: give stragglers a short grace period instead of the full timeout
+            self.deadline = min(self.deadline, now + max(self.grace, self.pacing))
 
-def process_responses(command, responses):
-    # Filter out '-joined' messages and ensure unique responses
-    responses = set(resp for resp in responses if not resp.startswith("-joined"))
+    def is_complete(self, now):
+        return now >= self.deadline
 
-    # Handling unrecognized command response
-    if any("The command" in resp for resp in responses):
-        print(next(resp for resp in responses if "The command" in resp))
+#Routes one received line to the command it answers: by nonce when the report
+#is tagged, otherwise to the oldest command still waiting for that kind of reply.
+def route_line(pending, line, hub=None):
+    route_report(pending, *text_report(line), hub=hub)
+
+#route_line for a report that is already split into its fields.
+def route_report(pending, kind, nonce, nick, detail, line, hub=None):
+    roster.observe(kind, nick, detail, hub=hub)
+    if nonce:
+        target = pending.get(nonce)
+        if target and nonce in target.versions:
+            # The bot verified a line signed with this scheme, so that is the one it uses
+            roster.learn_auth(nick, target.versions[nonce])
+    else:
+        target = next((p for p in pending.values() if p.accepts_untagged(kind, nick, line)), None)
+    if target:
+        replies_received.inc()
+        target.add(kind, nick, detail, line, hub)
+    elif kind != "-joined":
+        unmatched_lines.inc()
+
+#Handles the local "set" prompt commands that tune response collection.
+def handle_setting(settings, command):
+    parts = command.split()
+    try:
+        if len(parts) == 3 and parts[1] == "timeout":
+            settings["timeout"] = float(parts[2])
+        elif len(parts) == 4 and parts[1] == "timeout":
+            settings["timeouts"][parts[2]] = float(parts[3])
+        elif len(parts) == 3 and parts[1] == "quorum":
+            settings["quorum"] = float(parts[2])
+        elif len(parts) == 3 and parts[1] == "grace":
+            settings["grace"] = float(parts[2])
+        elif len(parts) == 3 and parts[1] == "expect":
+            settings["expect"] = None if parts[2] == "auto" else int(parts[2])
+        elif len(parts) == 3 and parts[1] == "stale":
+            settings["stale"] = float(parts[2])
+        elif len(parts) == 3 and parts[1] == "pacing":
+            settings["pacing"] = float(parts[2])
+        elif len(parts) != 1:
+            print("Usage: set [timeout [<command>] <seconds> | quorum <fraction> | grace <seconds> | "
+                  "expect <count|auto> | stale <seconds> | pacing <seconds>]")
+            return
+    except ValueError:
+        print(f"Invalid value: {parts[-1]}")
         return
 
-    # Handling the 'status' command
-    if command == "status":
-        bots = [resp for resp in responses if resp.startswith("-status")]
-        if bots:
+    fields = [f"timeout={settings['timeout']}s"]
+    fields += [f"timeout[{name}]={value}s" for name, value in settings["timeouts"].items()]
+    fields += [f"quorum={settings['quorum']}", f"grace={settings['grace']}s",
+               f"expect={settings['expect'] or 'auto'}", f"stale={settings['stale']}s",
+               f"pacing={settings['pacing']}s", f"known bots={len(roster)}"]
+    print(" ".join(fields))
+
+# One reply line parsed once: kind ("-status", "-attack", ..., or "error" for
+# unknown-command replies), the bot's nick, OK/FAIL for attacks, and the rest.
+Reply = namedtuple("Reply", ["kind", "nick", "outcome", "detail"])
+
+def parse_reply(line):
+    if "The command" in line:
+        return Reply("error", None, None, line)
+    kind, _, nick, detail = parse_report(line)
+    outcome = None
+    if kind == "-attack":
+        outcome, _, detail = detail.partition(" ")
+    return Reply(kind, nick, outcome, detail)
+
+# Builds a command's summary while its replies arrive. Each line is parsed
+# once and only bumps the counters and per-bot results it belongs to, so the
+# cost grows linearly with the number of replies.
+class ResponseAggregator:
+    __slots__ = ("command", "received", "seen", "error", "results", "succeeded", "failed", "bots")
+
+    def __init__(self, command):
+        self.command = command
+        # Every line handed in, -joined included, like the old raw response list
+        self.received = 0
+        # Identical lines are only counted once
+        self.seen = set()
+        # First error reply (unknown command or invalid arguments), which replaces the whole summary
+        self.error = None
+        # Summary lines per report kind, in arrival order
+        self.results = {"-status": [], "-shutdown": [], "-move": []}
+        self.succeeded = []
+        self.failed = []
+        # Latest reply from each bot
+        self.bots = {}
+
+    def add_line(self, line):
+        self.add(parse_reply(line), line)
+
+    def add(self, reply, line):
+        self.received += 1
+        if reply.kind == "-joined" or line in self.seen:
+            return
+        self.seen.add(line)
+
+        if reply.kind == "error":
+            self.error = self.error or line
+            return
+        if reply.nick:
+            self.bots[reply.nick] = reply
+        if reply.kind == "-attack":
+            if reply.outcome == "OK":
+                self.succeeded.append(reply.nick)
+            elif reply.outcome == "FAIL":
+                self.failed.append(f"{reply.nick} {reply.detail}".rstrip())
+        elif reply.kind in self.results:
+            self.results[reply.kind].append(f"{reply.nick} {reply.detail}".rstrip())
+
+    #Per-bot results and counts, for batch mode's JSON output.
+    def as_dict(self):
+        bots = {nick: {"kind": reply.kind.lstrip("-"), "outcome": reply.outcome, "detail": reply.detail}
+                for nick, reply in self.bots.items()}
+        counts = {"lines": self.received, "replies": len(bots), "succeeded": len(self.succeeded),
+                  "failed": len(self.failed)}
+        return {"bots": bots, "counts": counts, "error": self.error}
+
+    #Prints the summary for a finished command, including when nothing came back.
+    def summary(self):
+        command = self.command
+        if self.received:
+            # Processes and formats responses based on command
+            self.report()
+        else:
+            # Handle "shutdown" and "status" commands directly as before
+            if command == "shutdown" or command == "status":
+                print(f"Result: 0 bots {command}.")
+            # Special handling for "attack" commands which may have additional arguments
+            elif command.startswith("attack"):
+                print("Result: 0 bots attacked successfully:\n0 bots failed to attack:")
+            else:
+                print("No responses received. It's possible no bots are currently connected.")
+
+    def report(self):
+        command = self.command
+        # Handling unrecognized command response
+        if self.error:
+            print(self.error)
+            return
+
+        # Handling the 'status' command
+        if command == "status":
+            bots = self.results["-status"]
             print(f"\nResult: {len(bots)} bots discovered.")
             for bot in bots:
-                print(bot.replace("-status ", ""))
-        else:
-            print(f"\nResult: 0 bots discovered.")
+                print(bot)
 
-    # Handling the 'shutdown' command
-    elif command == "shutdown":
-        bots_shutdown = [resp for resp in responses if resp.startswith("-shutdown")]
-        if bots_shutdown:
+        # Handling the 'shutdown' command
+        elif command == "shutdown":
+            bots_shutdown = self.results["-shutdown"]
             print(f"\nResult: {len(bots_shutdown)} bots shut down.")
             for bot in bots_shutdown:
-                print(bot.replace("-shutdown ", ""))
-        else:
-            print(f"\nResult: 0 bots shut down.")
-
-    # Handling the 'attack' command
-    elif command.startswith("attack"):
-        if responses:
-            success = [resp for resp in responses if "OK" in resp]
-            failed = [resp for resp in responses if "FAIL" in resp]
-            print(f"\nResult: {len(success)} bots attacked successfully:")
-            for s in success:
-                print(s.replace("-attack ", "").replace(" OK", ""))
-            if failed:
-                print(f"{len(failed)} bots failed to attack:")
-                for f in failed:
-                    print(f.replace("-attack ", "").replace(" FAIL", ""))
+                print(bot)
+
+        # Handling the 'attack' command
+        elif command.startswith("attack"):
+            if self.seen:
+                print(f"\nResult: {len(self.succeeded)} bots attacked successfully:")
+                for bot in self.succeeded:
+                    print(bot)
+                if self.failed:
+                    print(f"{len(self.failed)} bots failed to attack:")
+                    for bot in self.failed:
+                        print(bot)
+            else:
+                # Adjusted message for clarity when no bots are connected
+                print("Result: 0 bots attacked successfully:\n0 bots failed to attack:")
+
+        # Handling the 'move' command
+        elif command.startswith("move") and self.seen:
+            moved_bots = self.results["-move"]
+            if moved_bots:
+                print(f"\nResult: {len(moved_bots)} bots moved.")
+                for moved_bot in moved_bots:
+                    print(moved_bot)
+            else:
+                print("No bots have moved or no move responses received.")
+
+# Results kept per schedule, and the default random delay of periodic runs as a fraction of their interval
+DEFAULT_SCHEDULE_HISTORY = 20
+DEFAULT_SCHEDULE_JITTER = 0.1
+
+DURATION_UNITS = (("ms", 0.001), ("s", 1), ("m", 60), ("h", 3600))
+# Prompt commands handled by handle_schedule
+SCHEDULE_COMMANDS = ("every", "at", "schedules", "history", "cancel")
+
+#Parses "250ms", "30s", "5m", "1.5h" or plain seconds; raises ValueError.
+def parse_duration(value):
+    scale = 1
+    for unit, unit_scale in DURATION_UNITS:
+        if value.endswith(unit):
+            value, scale = value[:-len(unit)], unit_scale
+            break
+    seconds = float(value) * scale
+    if not 0 <= seconds < math.inf:
+        raise ValueError(f"invalid duration: {value}")
+    return seconds
+
+#Parses "+<duration>" or a local "HH:MM[:SS]" (the next one to come) into a Unix time.
+def parse_time(value, now):
+    if value.startswith("+"):
+        return now + parse_duration(value[1:])
+    fields = [int(field) for field in value.split(":")]
+    if len(fields) not in (2, 3):
+        raise ValueError(f"invalid time: {value}")
+    hour, minute, second = (fields + [0])[:3]
+    if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+        raise ValueError(f"invalid time: {value}")
+    today = time.localtime(now)
+    when = time.mktime((today.tm_year, today.tm_mon, today.tm_mday, hour, minute, second, 0, 0, -1))
+    # A time that has passed today means tomorrow
+    return when if when > now else when + 86400
+
+def format_duration(seconds):
+    if seconds >= 3600 and seconds % 3600 == 0:
+        return f"{seconds / 3600:g}h"
+    if seconds >= 60 and seconds % 60 == 0:
+        return f"{seconds / 60:g}m"
+    return f"{seconds:g}s"
+
+# One scheduled command: a single run at a set time, or a run every `interval`
+# seconds. Periodic runs keep to their cadence (base, base + interval, ...) and
+# each is delayed by up to `jitter` random seconds. A run that comes due while
+# the previous one is still collecting replies is skipped.
+class Schedule:
+    __slots__ = ("id", "command", "interval", "jitter", "base", "next_at", "runs", "skipped", "running", "history")
+
+    def __init__(self, schedule_id, command, when, interval=None, jitter=0, history=DEFAULT_SCHEDULE_HISTORY):
+        self.id = schedule_id
+        self.command = command
+        self.interval = interval
+        self.jitter = jitter
+        self.base = when
+        self.next_at = when
+        self.runs = 0
+        self.skipped = 0
+        # The PendingCommand of the run in flight
+        self.running = None
+        # Results of the latest runs, oldest first
+        self.history = deque(maxlen=history)
+
+    def describe(self):
+        if self.interval is None:
+            return f"#{self.id} at {time.strftime('%H:%M:%S', time.localtime(self.base))} {self.command}"
+        jitter = f" jitter {format_duration(round(self.jitter, 3))}" if self.jitter else ""
+        return f"#{self.id} every {format_duration(self.interval)}{jitter} {self.command}"
+
+    #Files the result of a finished run and returns it.
+    def record(self, command, now):
+        self.running = None
+        result = {"time": round(command.sent_at, 3), "nonce": command.nonce, "ok": command_succeeded(command),
+                  "replies": len(command.responders), "expected": command.expected_count,
+                  "latency_ms": round((now - command.sent_at) * 1000, 3), "error": command.aggregator.error}
+        self.history.append(result)
+        return result
+
+# Scheduled commands in a heap ordered by when they are due next, served from
+# the controller's select loop. Cancelled schedules leave their heap entry
+# behind; it is dropped when it reaches the top.
+class Scheduler:
+    def __init__(self, jitter=DEFAULT_SCHEDULE_JITTER, history=DEFAULT_SCHEDULE_HISTORY, rng=None):
+        self.jitter = jitter
+        self.history = history
+        # Seeded from the system, so controllers started together still drift apart
+        self.rng = rng or random.Random()
+        self.schedules = {}
+        self.heap = []
+        self.ids = itertools.count(1)
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.schedules)
+
+    #Runs `command` every `interval` seconds, the first run after up to one jitter.
+    def every(self, interval, command, jitter=None, now=None):
+        now = time.time() if now is None else now
+        jitter = self.jitter * interval if jitter is None else jitter
+        schedule = Schedule(next(self.ids), command, now, interval, jitter, self.history)
+        schedule.next_at = now + self.rng.uniform(0, jitter)
+        return self.add(schedule)
+
+    def at(self, when, command):
+        return self.add(Schedule(next(self.ids), command, when, history=self.history))
+
+    def add(self, schedule):
+        self.schedules[schedule.id] = schedule
+        heapq.heappush(self.heap, (schedule.next_at, next(self.sequence), schedule))
+        return schedule
+
+    def cancel(self, schedule_id):
+        return self.schedules.pop(schedule_id, None)
+
+    def clear(self):
+        self.schedules.clear()
+        self.heap.clear()
+
+    #Drops heap entries of cancelled schedules from the top.
+    def prune(self):
+        while self.heap and self.schedules.get(self.heap[0][2].id) is not self.heap[0][2]:
+            heapq.heappop(self.heap)
+
+    #Unix time the next schedule is due, or None if there is none.
+    def next_due(self):
+        self.prune()
+        return self.heap[0][0] if self.heap else None
+
+    #Pops every schedule due at `now` and queues the next run of periodic ones.
+    def due(self, now):
+        ready = []
+        while self.next_due() is not None and self.heap[0][0] <= now:
+            _, _, schedule = heapq.heappop(self.heap)
+            ready.append(schedule)
+            if schedule.interval is None:
+                del self.schedules[schedule.id]
+                continue
+            # Keep the cadence; runs missed while the loop was busy are not made up
+            schedule.base += schedule.interval
+            if schedule.base <= now:
+                schedule.base += schedule.interval * math.ceil((now - schedule.base) / schedule.interval)
+            schedule.next_at = schedule.base + self.rng.uniform(0, schedule.jitter)
+            heapq.heappush(self.heap, (schedule.next_at, next(self.sequence), schedule))
+        return ready
+
+    def stats(self):
+        return {"schedules": len(self.schedules),
+                "runs": sum(schedule.runs for schedule in self.schedules.values()),
+                "skipped": sum(schedule.skipped for schedule in self.schedules.values())}
+
+#Handles the schedule prompt commands: "every <interval> [jitter <duration>] <command>",
+#"at <HH:MM[:SS]|+duration> <command>", "schedules", "history <id>" and "cancel <id>".
+def handle_schedule(scheduler, command):
+    parts = command.split()
+    verb = parts[0]
+    try:
+        jitter = None
+        if verb == "every" and len(parts) >= 3 and parts[2] == "jitter":
+            # Take the jitter clause off first, so it is never mistaken for the command
+            jitter = parse_duration(parts[3]) if len(parts) > 3 else None
+            parts = parts[:2] + parts[4:]
+        if verb == "every" and len(parts) >= 3:
+            interval = parse_duration(parts[1])
+            if not interval:
+                raise ValueError("the interval must be above zero")
+            print(f"Scheduled {scheduler.every(interval, ' '.join(parts[2:]), jitter).describe()}")
+        elif verb == "at" and len(parts) >= 3:
+            when = parse_time(parts[1], time.time())
+            print(f"Scheduled {scheduler.at(when, ' '.join(parts[2:])).describe()}")
+        elif verb == "cancel" and len(parts) == 2:
+            schedule = scheduler.cancel(int(parts[1].lstrip("#")))
+            print(f"Cancelled {schedule.describe()}" if schedule else f"No schedule {parts[1]}")
+        elif verb == "history" and len(parts) == 2:
+            schedule = scheduler.schedules.get(int(parts[1].lstrip("#")))
+            if schedule is None:
+                print(f"No schedule {parts[1]}")
+                return
+            print(schedule.describe())
+            for result in schedule.history:
+                print(f"{time.strftime('%H:%M:%S', time.localtime(result['time']))} {describe_result(result)}")
+        elif verb == "schedules" and len(parts) == 1:
+            if not scheduler.schedules:
+                print("No schedules.")
+            now = time.time()
+            for schedule in scheduler.schedules.values():
+                last = f"; last: {describe_result(schedule.history[-1])}" if schedule.history else ""
+                print(f"{schedule.describe()}: {schedule.runs} runs, {schedule.skipped} skipped, "
+                      f"next in {max(schedule.next_at - now, 0):.1f}s{last}")
         else:
-            # Adjusted message for clarity when no bots are connected
-            print("Result: 0 bots attacked successfully:\n0 bots failed to attack:")
-
-    # Handling the 'move' command
-    elif command.startswith("move") and responses:
-        moved_bots = [resp for resp in responses if resp.startswith("-move")]
-        if moved_bots:
-            print(f"\nResult: {len(moved_bots)} bots moved.")
-            for moved_bot in moved_bots:
-                print(moved_bot.replace("-move ", ""))
+            print("Usage: every <interval> [jitter <duration>] <command> | at <HH:MM[:SS]|+duration> <command> | "
+                  "schedules | history <id> | cancel <id>")
+    except ValueError as e:
+        print(f"Invalid value: {e}")
+
+def describe_result(result):
+    outcome = "ok" if result["ok"] else "FAILED"
+    expected = "?" if not result["expected"] else result["expected"]
+    return f"{result['replies']}/{expected} bots answered in {result['latency_ms']} ms, {outcome}"
+
+def prompt():
+    print("\ncmd> ", end="", flush=True)
+
+#Reply collection settings, changed from the prompt with "set". `pacing` comes
+#from the transport: replies over IRC arrive at the server's pace.
+def default_settings(pacing=0):
+    return {"timeout": DEFAULT_TIMEOUT, "timeouts": {}, "quorum": DEFAULT_QUORUM, "grace": DEFAULT_GRACE,
+            "expect": None, "stale": DEFAULT_STALE_AFTER, "pacing": pacing}
+
+#Seconds select may sleep: until the next command deadline or until a hub needs
+#attention, whichever comes first. None waits indefinitely.
+def wait_time(deadline, fleet):
+    waits = [fleet.timeout()]
+    if deadline is not None:
+        waits.append(max(deadline - time.time(), 0))
+    return min((wait for wait in waits if wait is not None), default=None)
+
+#Signs a command (once per auth scheme in use), sends it to every hub that is up
+#and files it in `pending` under each nonce.
+def start_command(fleet, command, secret, settings, pending, auth="auto"):
+    # v2 MACs cover the text the bots rebuild, with single spaces
+    command = " ".join(command.split())
+    verb = command.split()[0]
+    expected = settings["expect"] or roster.nicks()
+    pending_command = PendingCommand(command, None, settings["timeouts"].get(verb, settings["timeout"]),
+                                     expected, settings["quorum"], settings["grace"], settings["pacing"])
+    if not fleet.up():
+        log.warning("No hub is up; '%s' was not sent.", command)
+    # Mixed fleets get one line per auth scheme; every bot verifies only its own
+    for version in (roster.auth_versions() if auth == "auto" else (auth,)):
+        nonce = generate_nonce()
+        fleet.send(nonce, compute_mac(nonce, secret, version, command), command)
+        commands_sent.inc()
+        pending_command.nonce = pending_command.nonce or nonce
+        pending_command.versions[nonce] = version
+        pending[nonce] = pending_command
+    return pending_command
+
+#Lets the hubs act on what select reported and routes what they received; bots
+#on hubs that went down are no longer waited for.
+def route_fleet(fleet, pending, readable=(), writable=()):
+    reports, gone = fleet.poll(readable, writable)
+    for hub, report in reports:
+        route_report(pending, *report, hub=hub)
+    if gone:
+        for command in set(pending.values()):
+            command.forget(gone)
+
+#Waits once for the hubs (and any other `readers`) and handles what happened.
+def poll_fleet(fleet, pending, readers=(), deadline=None):
+    readable, writable, _ = select.select(fleet.readers() + list(readers), fleet.writers(), [],
+                                          wait_time(deadline, fleet))
+    route_fleet(fleet, pending, readable, writable)
+    return readable
+
+#Replies and latency per hub, for hubs that answered and hubs that are down alike.
+def hub_breakdown(command, fleet):
+    hubs = {}
+    for link in fleet.links:
+        replies, seconds = command.hub_replies.get(link.name, (0, None))
+        hubs[link.name] = {"up": link in fleet.up(), "replies": replies,
+                           "latency_ms": None if seconds is None else round(seconds * 1000, 3)}
+    return hubs
+
+def print_hub_breakdown(command, fleet):
+    print("Hubs:")
+    for name, hub in hub_breakdown(command, fleet).items():
+        if hub["replies"]:
+            print(f"{name} {hub['replies']} replies, last after {hub['latency_ms']} ms")
         else:
-            print("No bots have moved or no move responses received.")
-    
+            print(f"{name} no replies{'' if hub['up'] else ' (down)'}")
 
-def main():
-    hostname, port, secret = parse_arguments()
-    
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            sock.connect((hostname, port))
-            print("Connected to the server.")
-            
-            while True:
-                command = input("\ncmd> ").strip()
+#Runs the prompt, the scheduled commands and the reply collection in one select
+#loop, so several commands can be in flight at once. Each command reports as
+#soon as it completes; periodic ones in a single line.
+def run_controller(fleet, secret, auth="auto", scheduler=None):
+    settings = default_settings(fleet.pacing)
+    scheduler = scheduler or Scheduler()
+    pending = {}
+    typed = bytearray()
+    stdin = sys.stdin.fileno()
+    closing = False
+
+    prompt()
+    while not (closing and not pending):
+        deadlines = [p.deadline for p in pending.values()]
+        if not closing and len(scheduler):
+            deadlines.append(scheduler.next_due())
+        next_deadline = min((deadline for deadline in deadlines if deadline is not None), default=None)
+        readable = poll_fleet(fleet, pending, () if closing else (stdin,), next_deadline)
+
+        if stdin in readable:
+            # Read the descriptor directly: buffered readline could hide queued lines from select
+            data = os.read(stdin, 4096)
+            if not data:
+                closing = True
+            for command in split_lines(typed, data):
                 if command.lower() == "quit":
-                    print("Exiting controller.")
+                    closing = True
                     break
-                
-                send_command(sock, command, secret)
-                responses = receive_responses(sock)
-                
-                if responses:
-                    # Processes and formats responses based on command
-                    process_responses(command, responses)  
+                if command.split()[0] == "set":
+                    handle_setting(settings, command)
+                elif command.split()[0] in SCHEDULE_COMMANDS:
+                    handle_schedule(scheduler, command)
+                elif command == "roster":
+                    # Answered from the local cache, nothing is sent to the bots
+                    roster.show(settings["stale"])
                 else:
-                    # Handle "shutdown" and "status" commands directly as before
-                    if command == "shutdown" or command == "status":
-                        print(f"Result: 0 bots {command}.")
-                    # Special handling for "attack" commands which may have additional arguments
-                    elif command.startswith("attack"):
-                        print("Result: 0 bots attacked successfully:\n0 bots failed to attack:")
-                    else:
-                        print("No responses received. It's possible no bots are currently connected.")
+                    start_command(fleet, command, secret, settings, pending, auth)
+            # Send right away rather than on the next wakeup
+            route_fleet(fleet, pending)
+            in_flight = len(set(map(id, pending.values())))
+            if closing and pending:
+                print(f"Waiting for {in_flight} command(s) in flight.")
+            elif not closing:
+                prompt()
+
+        now = time.time()
+        if not closing:
+            due = scheduler.due(now)
+            for schedule in due:
+                if schedule.running:
+                    # The previous run is still collecting replies
+                    schedule.skipped += 1
+                    continue
+                schedule.runs += 1
+                schedule.running = start_command(fleet, schedule.command, secret, settings, pending, auth)
+                schedule.running.schedule = schedule
+            if due:
+                route_fleet(fleet, pending)
+
+        for command in {id(command): command for command in pending.values()}.values():
+            if command.is_complete(now):
+                for nonce in command.versions:
+                    del pending[nonce]
+                command_seconds.observe(now - command.sent_at)
+                schedule = command.schedule
+                if schedule:
+                    result = schedule.record(command, now)
+                    if schedule.interval is not None:
+                        print(f"\n[{schedule.describe()}] {describe_result(result)}")
+                        if not closing:
+                            prompt()
+                        continue
+                    print(f"\n[{schedule.describe()}]")
+                # Label results when other commands were in flight alongside this one
+                elif pending:
+                    print(f"\n[{command.command}]")
+                command.aggregator.summary()
+                if len(fleet.links) > 1:
+                    print_hub_breakdown(command, fleet)
+                if not closing:
+                    prompt()
+
+    print("Exiting controller.")
+
+#Sends one command and routes replies until it completes; returns its PendingCommand.
+def run_command(fleet, secret, command, settings, auth="auto"):
+    pending = {}
+    pending_command = start_command(fleet, command, secret, settings, pending, auth)
+    route_fleet(fleet, pending)
+    while not pending_command.is_complete(time.time()):
+        poll_fleet(fleet, pending, deadline=pending_command.deadline)
+    command_seconds.observe(time.time() - pending_command.sent_at)
+    return pending_command
+
+#True when every expected bot answered (or, with nothing expected, at least one
+#did) and no bot rejected the command or failed an attack.
+def command_succeeded(command):
+    aggregator = command.aggregator
+    if aggregator.error or aggregator.failed:
+        return False
+    if command.expected_count:
+        return command.answered >= command.expected_count
+    return bool(command.responders)
+
+#Gives the hubs up to `wait` seconds to answer the roster request that follows
+#their greeting, so the first command already knows which bots to wait for. IRC
+#servers send no roster.
+def await_roster(fleet, wait=DEFAULT_GRACE):
+    if fleet.options.irc:
+        return
+    deadline = time.time() + wait
+    while not len(roster) and fleet.up() and time.time() < deadline:
+        poll_fleet(fleet, {}, deadline=deadline)
+
+#Runs commands from `lines` one after another, printing one JSON object per
+#command. Returns the exit status: 0 if every command succeeded, 1 otherwise.
+def run_batch(fleet, secret, lines, auth="auto"):
+    settings = default_settings(fleet.pacing)
+    status = 0
+    await_roster(fleet)
+
+    for command in lines:
+        command = command.strip()
+        if not command or command.startswith("#"):
+            continue
+        if command.lower() == "quit":
+            break
+        if command.split()[0] in SCHEDULE_COMMANDS:
+            log.warning("'%s' only works at the prompt; skipped.", command)
+            continue
+        if command.split()[0] == "set":
+            # Settings feedback is for people: keep stdout to JSON only
+            with contextlib.redirect_stdout(sys.stderr):
+                handle_setting(settings, command)
+            continue
+        if command == "roster":
+            now = time.time()
+            bots = {record.nick: {"commands": record.command_count, "auth": record.auth, "hub": record.hub,
+                                  "last_seen_seconds": round(now - record.last_seen, 3)}
+                    for record in roster.bots.values()}
+            print(json.dumps({"command": command, "bots": bots, "counts": {"known": len(bots)}}), flush=True)
+            continue
+
+        pending_command = run_command(fleet, secret, command, settings, auth)
+        ok = command_succeeded(pending_command)
+        status = status or (0 if ok else 1)
+        result = {"command": command, "nonce": pending_command.nonce,
+                  "latency_ms": round((time.time() - pending_command.sent_at) * 1000, 3), "ok": ok}
+        result.update(pending_command.aggregator.as_dict())
+        result["counts"]["expected"] = pending_command.expected_count
+        result["hubs"] = hub_breakdown(pending_command, fleet)
+        print(json.dumps(result), flush=True)
+    return status
+
+def main():
+    hubs, secret, options = parse_arguments()
+    # Logs go to stderr: stdout is the prompt, the results and batch JSON
+    setup_logging(options.log_level, options.log_sample, sys.stderr)
+    if options.record:
+        wirelog.start_recording(options.record)
+    fleet = Fleet(hubs, options, policy_from_args(options), resolver_from_args(options))
+    registry.collect("controller_roster", lambda: {"bots": len(roster)})
+    registry.collect("controller_hubs", fleet.stats)
+    registry.collect("controller_reconnect", fleet.policy.stats)
+    scheduler = Scheduler(options.schedule_jitter, options.schedule_history)
+    registry.collect("controller_schedules", scheduler.stats)
+    start_metrics(options.metrics)
+
+    if options.batch:
+        # Batch mode: JSON on stdout, everything else on stderr, status in the exit code
+        try:
+            with contextlib.closing(fleet), \
+                    (sys.stdin if options.batch == "-" else open(options.batch)) as lines:
+                up = fleet.connect()
+                log.info("Connected to %d of %d hubs.", len(up), len(fleet.links))
+                sys.exit(run_batch(fleet, secret, lines, options.auth))
+        except (OSError, RuntimeError) as e:
+            log.error("Error: %s", e)
+            sys.exit(2)
+        except KeyboardInterrupt:
+            sys.exit(130)
+
+    try:
+        with contextlib.closing(fleet):
+            up = fleet.connect()
+            if len(fleet.links) == 1:
+                print("Connected to the server.")
+            else:
+                print(f"Connected to {len(up)} of {len(fleet.links)} hubs.")
+            run_controller(fleet, secret, options.auth, scheduler)
                     
     except Exception as e:
         print(f"Error: {e}")
@@ -181,4 +1309,4 @@ def main():
     
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
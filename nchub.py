@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# Local broadcast hub for ncbot.py and nccontrolller.py. Every line a client
+# sends is relayed to every other connected client, which is what the bots and
+# the controller expect from the server they share. Binary frames (see
+# framing.py) are relayed whole, like lines.
+import argparse
+import resource
+import selectors
+import socket
+from collections import deque
+
+from framing import CAPABILITY, MARKER, message_end
+from heartbeat import PING_CAPABILITY, PONG_LINE
+
+
+# Longest line a client may send before we give up on it
+MAX_LINE_LENGTH = 4096
+# Bytes waiting to be written to one client before it counts as too slow
+DEFAULT_QUEUE_LIMIT = 256 * 1024
+DEFAULT_BACKLOG = 1024
+
+
+# One connected client with its own bounded write queue
+class Client:
+    __slots__ = ("sock", "address", "inbox", "outbox", "offset", "queued", "writing", "joined", "send_error")
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        # Partial line waiting for its newline
+        self.inbox = bytearray()
+        # Shared broadcast chunks still to be sent, and how far into the first one we are
+        self.outbox = deque()
+        self.offset = 0
+        self.queued = 0
+        self.writing = False
+        # The client's latest -joined line, passed on to clients that connect later
+        self.joined = None
+        # Why sending to the client failed; it is still read from until it closes
+        self.send_error = None
+
+
+class Hub:
+    client_class = Client
+
+    def __init__(self, host="0.0.0.0", port=6667, queue_limit=DEFAULT_QUEUE_LIMIT, backlog=DEFAULT_BACKLOG):
+        self.queue_limit = queue_limit
+        self.selector = selectors.DefaultSelector()
+        self.clients = {}
+        self.running = False
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(backlog)
+        self.listener.setblocking(False)
+        self.address = self.listener.getsockname()
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+        # Lets stop() wake the loop from another thread
+        self.waker, self.wake_signal = socket.socketpair()
+        self.waker.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ)
+
+    def serve_forever(self):
+        self.running = True
+        while self.running:
+            for key, events in self.selector.select(self.timeout()):
+                if key.fileobj is self.listener:
+                    self.accept()
+                elif key.fileobj is self.waker:
+                    self.waker.recv(64)
+                else:
+                    client = key.data
+                    # Skip clients dropped earlier in this same batch of events
+                    if events & selectors.EVENT_READ and client.sock.fileno() != -1:
+                        self.read(client)
+                    if events & selectors.EVENT_WRITE and client.sock.fileno() != -1:
+                        self.write(client)
+            self.tick()
+        self.close()
+
+    #Seconds the loop may sleep waiting for events; None waits indefinitely.
+    def timeout(self):
+        return None
+
+    #Called after every pass of the loop, for subclasses with timed work.
+    def tick(self):
+        pass
+
+    def stop(self):
+        self.running = False
+        try:
+            self.wake_signal.send(b"x")
+        except OSError:
+            pass
+
+    def accept(self):
+        # Take every pending connection, not just one per wakeup
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"Accept error: {e}")
+                return
+            sock.setblocking(False)
+            # Relayed lines are small: send them now instead of waiting to coalesce
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = self.client_class(sock, address)
+            self.clients[sock] = client
+            self.selector.register(sock, selectors.EVENT_READ, client)
+            self.greet(client)
+
+    #Tells a new client what the hub supports: binary frames and heartbeat pings.
+    def greet(self, client):
+        self.send_to(client, f"-hub {CAPABILITY} {PING_CAPABILITY}\n".encode())
+
+    def read(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.drop(client, f"receive error: {e}")
+            return
+        if not data:
+            self.drop(client)
+            return
+
+        inbox = client.inbox
+        inbox += data
+        if MARKER in inbox:
+            # A frame's length is in its header and its payload may hold newlines
+            end = 0
+            while end < len(inbox):
+                stop = message_end(inbox, end, len(inbox))
+                if stop is None:
+                    break
+                end = stop
+        else:
+            end = inbox.rfind(b"\n") + 1
+        if end:
+            # All complete messages go out as one chunk; the partial one stays behind
+            chunk = bytes(inbox[:end])
+            del inbox[:end]
+            if b"-joined" in chunk or b"-hub" in chunk:
+                chunk = self.inspect(client, chunk)
+            if chunk:
+                self.broadcast(client, chunk)
+        if len(inbox) > MAX_LINE_LENGTH:
+            self.drop(client, f"line longer than {MAX_LINE_LENGTH} bytes")
+
+    #Keeps the -joined announcements in a chunk of complete messages, answers
+    #"-hub joined" with everybody else's, so a controller that connects after its
+    #bots still learns their capabilities, and answers heartbeat pings. Returns
+    #the chunk minus the requests, which are not relayed.
+    def inspect(self, client, chunk):
+        relayed = bytearray()
+        start = 0
+        while start < len(chunk):
+            stop = message_end(chunk, start, len(chunk))
+            message = chunk[start:stop]
+            start = stop
+            if message.startswith(b"-joined"):
+                client.joined = message
+            elif message.rstrip() == b"-hub joined":
+                joined = [other.joined for other in self.clients.values() if other.joined and other is not client]
+                if joined:
+                    self.send_to(client, b"".join(joined))
+                continue
+            elif message.rstrip() == b"-hub ping":
+                self.send_to(client, PONG_LINE)
+                continue
+            relayed += message
+        return bytes(relayed)
+
+    def broadcast(self, sender, chunk):
+        for client in list(self.clients.values()):
+            if client is sender:
+                continue
+            self.send_to(client, chunk)
+
+    def send_to(self, client, chunk):
+        if client.send_error:
+            return
+        if client.queued + len(chunk) > self.queue_limit:
+            # A slow consumer is cut off instead of holding everybody's memory
+            self.drop(client, f"write queue over {self.queue_limit} bytes")
+            return
+        client.outbox.append(chunk)
+        client.queued += len(chunk)
+        if not client.writing:
+            self.write(client)
+
+    def write(self, client):
+        outbox = client.outbox
+        try:
+            while outbox:
+                head = outbox[0]
+                sent = client.sock.send(memoryview(head)[client.offset:])
+                client.offset += sent
+                client.queued -= sent
+                if client.offset < len(head):
+                    break
+                outbox.popleft()
+                client.offset = 0
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            self.stop_writing(client, f"send error: {e}")
+            return
+
+        # Only wait for writability while something is queued
+        want_write = bool(outbox)
+        if want_write != client.writing:
+            client.writing = want_write
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            self.selector.modify(client.sock, events, client)
+
+    #Gives up on sending to a client whose connection broke (EPIPE, ECONNRESET), but
+    #keeps reading until it closes: its last lines, such as a bot's -shutdown
+    #report, may still be waiting unread and are relayed before it is dropped.
+    def stop_writing(self, client, reason):
+        client.send_error = reason
+        client.outbox.clear()
+        client.offset = 0
+        client.queued = 0
+        client.writing = False
+        self.selector.modify(client.sock, selectors.EVENT_READ, client)
+
+    def drop(self, client, reason=None):
+        if self.clients.pop(client.sock, None) is None:
+            return
+        reason = reason or client.send_error
+        if reason:
+            print(f"Disconnecting {client.address[0]}:{client.address[1]}: {reason}")
+        self.selector.unregister(client.sock)
+        client.sock.close()
+
+    def close(self):
+        for client in list(self.clients.values()):
+            self.drop(client)
+        for sock in (self.listener, self.waker, self.wake_signal):
+            sock.close()
+        self.selector.close()
+
+
+#Allows as many open sockets as the hard limit permits, for fleets of thousands.
+def raise_open_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Broadcast hub that relays every line to all other clients.')
+    parser.add_argument('address', help='Port to listen on, or hostname:port')
+    parser.add_argument('--queue-limit', type=int, default=DEFAULT_QUEUE_LIMIT,
+                        help='Bytes queued for one client before it is disconnected (default: %(default)s)')
+    args = parser.parse_args()
+    hostname, _, port = args.address.rpartition(':')
+    return hostname or "0.0.0.0", int(port), args.queue_limit
+
+def main():
+    hostname, port, queue_limit = parse_arguments()
+    raise_open_file_limit()
+    hub = Hub(hostname, port, queue_limit)
+    print(f"Hub listening on {hub.address[0]}:{hub.address[1]}")
+    try:
+        hub.serve_forever()
+    except KeyboardInterrupt:
+        print("Program has been exited.")
+        hub.close()
+
+if __name__ == "__main__":
+    main()
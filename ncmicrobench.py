@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# Micro-benchmarks for the CPU-bound paths of the bots and the controller:
+# command authentication, MAC computation, command parsing, the bots' report
+# classification, binary frame coding and reply aggregation. Unlike
+# ncbench.py nothing touches the network, so runs are cheap and repeatable.
+#
+# Workloads come from a fixed-seed generator. Each benchmark is warmed up,
+# timed over several repeats and run once more under tracemalloc for its
+# allocations. Results are JSON; with --baseline they are compared against a
+# stored run and the exit status is 1 if any per-message cost regressed.
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+import ircbot
+import ncbot
+import nccontrolller
+from botauth import AUTH_V1, AUTH_V2, authenticator_for
+from botcore import CommandGuard, parse_command
+from botlog import setup_logging
+from framing import decode_command, encode_command
+from nonce_store import NonceStore
+
+
+DEFAULT_SEED = 526
+DEFAULT_REPEATS = 7
+DEFAULT_WARMUP = 2
+# Allowed slowdown against the baseline before a result counts as a regression
+DEFAULT_TOLERANCE = 0.25
+SECRET = "benchSecret"
+# Messages per timed run for the per-message benchmarks
+MESSAGES = 2000
+AGGREGATION_SIZES = (10, 100, 1000, 10000, 100000)
+
+# `setup(rng, size)` builds a workload of `size` messages and returns a callable
+# that processes all of it once; it is called again before every timed run.
+Benchmark = namedtuple("Benchmark", ["name", "sizes", "setup"])
+
+
+#Fixed-seed synthetic traffic: nicks, nonces, command lines and bot reports.
+class Workload:
+    __slots__ = ("rng", "now", "counter")
+
+    def __init__(self, rng):
+        self.rng = rng
+        # Nonces must be inside the bots' window, so they start from the current time
+        self.now = int(time.time())
+        self.counter = 0
+
+    def nick(self):
+        return f"bot{self.rng.randrange(100000)}"
+
+    #Unique nonces in the generator's "<seconds>.<micros>-<instance>" form.
+    def nonce(self):
+        self.counter += 1
+        seconds = self.now - self.rng.randrange(60)
+        return f"{seconds}.{self.counter % 1000000:06d}-{self.rng.getrandbits(32):08x}"
+
+    def command(self):
+        rng = self.rng
+        verb = rng.choice(("status", "attack", "move", "shutdown"))
+        if verb in ("attack", "move"):
+            return f"{verb} 10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}:{rng.randrange(1, 65536)}"
+        return verb
+
+    def signed(self, version):
+        nonce = self.nonce()
+        command = self.command()
+        return f"{nonce} {nccontrolller.compute_mac(nonce, SECRET, version, command)} {command}"
+
+    #A line another bot or the hub puts on the wire, as ncbot sees it.
+    def report(self):
+        rng = self.rng
+        kind = rng.choice(("-status", "-attack", "-move", "-shutdown", "-joined", "error"))
+        if kind == "error":
+            return "The command 'foo' is not accepted."
+        if kind == "-joined":
+            return f"-joined {self.nick()} frame=1"
+        detail = {"-status": str(rng.randrange(1000)), "-attack": rng.choice(("OK", "FAIL Timeout"))}.get(kind, "")
+        return f"{kind}@{self.nonce()} {self.nick()} {detail}".rstrip()
+
+    #Replies to one attack command from `size` bots, some answering twice.
+    def attack_replies(self, size):
+        rng = self.rng
+        replies = []
+        for index in range(size):
+            nick = f"bot{index}" if rng.random() > 0.05 else f"bot{rng.randrange(max(1, index))}"
+            outcome = "OK" if rng.random() < 0.9 else f"FAIL {rng.choice(('Timeout or Unable to Connect', 'no such hostname'))}"
+            replies.append(f"-attack {nick} {outcome}")
+        return replies
+
+
+def each(function, items):
+    def run():
+        for item in items:
+            function(item)
+    return run
+
+def guard_setup(version):
+    def setup(rng, size):
+        workload = Workload(rng)
+        commands = [parse_command(workload.signed(version)) for _ in range(size)]
+        # A fresh store: every nonce is accepted once, so every run needs its own
+        guard = CommandGuard(authenticator_for(SECRET), version, NonceStore())
+        return each(guard.check, commands)
+    return setup
+
+def ircbot_auth_setup(version):
+    def setup(rng, size):
+        workload = Workload(rng)
+        commands = [parse_command(workload.signed(version)) for _ in range(size)]
+        ircbot.seen_nonces = NonceStore()
+        ircbot.guard = CommandGuard(authenticator_for(SECRET), version, ircbot.seen_nonces)
+        return each(ircbot.authenticate_command, commands)
+    return setup
+
+def compute_mac_setup(version):
+    def setup(rng, size):
+        workload = Workload(rng)
+        nonces = [workload.nonce() for _ in range(size)]
+        return each(lambda nonce: nccontrolller.compute_mac(nonce, SECRET, version, "status"), nonces)
+    return setup
+
+def parse_command_setup(rng, size):
+    workload = Workload(rng)
+    return each(parse_command, [workload.signed(AUTH_V1) for _ in range(size)])
+
+def ncbot_classify_setup(rng, size):
+    workload = Workload(rng)
+    session = ncbot.BotSession("bench", 0, "benchBot", SECRET)
+    return each(session.handle_line, [workload.report() for _ in range(size)])
+
+def ircbot_classify_setup(rng, size):
+    workload = Workload(rng)
+    return each(ircbot.process_command, [workload.report() for _ in range(size)])
+
+def frame_encode_setup(rng, size):
+    workload = Workload(rng)
+    lines = [workload.signed(AUTH_V1).split(maxsplit=2) for _ in range(size)]
+    return each(lambda parts: encode_command(*parts), lines)
+
+def frame_decode_setup(rng, size):
+    workload = Workload(rng)
+    frames = [memoryview(encode_command(*workload.signed(AUTH_V1).split(maxsplit=2))) for _ in range(size)]
+    return each(decode_command, frames)
+
+#The per-line work of summarising a command's replies, without printing the summary.
+def aggregate_setup(rng, size):
+    replies = Workload(rng).attack_replies(size)
+
+    def run():
+        aggregator = nccontrolller.ResponseAggregator("attack 127.0.0.1:80")
+        for line in replies:
+            aggregator.add_line(line)
+        aggregator.as_dict()
+    return run
+
+BENCHMARKS = [
+    Benchmark("ncbot.guard.check.v1", (MESSAGES,), guard_setup(AUTH_V1)),
+    Benchmark("ncbot.guard.check.v2", (MESSAGES,), guard_setup(AUTH_V2)),
+    Benchmark("ircbot.authenticate_command.v1", (MESSAGES,), ircbot_auth_setup(AUTH_V1)),
+    Benchmark("ircbot.authenticate_command.v2", (MESSAGES,), ircbot_auth_setup(AUTH_V2)),
+    Benchmark("controller.compute_mac.v1", (MESSAGES,), compute_mac_setup(AUTH_V1)),
+    Benchmark("controller.compute_mac.v2", (MESSAGES,), compute_mac_setup(AUTH_V2)),
+    Benchmark("botcore.parse_command", (MESSAGES,), parse_command_setup),
+    Benchmark("ncbot.handle_line.reports", (MESSAGES,), ncbot_classify_setup),
+    Benchmark("ircbot.process_command.reports", (MESSAGES,), ircbot_classify_setup),
+    Benchmark("framing.encode_command", (MESSAGES,), frame_encode_setup),
+    Benchmark("framing.decode_command", (MESSAGES,), frame_decode_setup),
+    Benchmark("controller.aggregate", AGGREGATION_SIZES, aggregate_setup),
+]
+
+
+#Times one benchmark at one size; costs are per message.
+def measure(benchmark, size, args):
+    for _ in range(args.warmup):
+        benchmark.setup(random.Random(args.seed), size)()
+
+    timings = []
+    for _ in range(args.repeats):
+        run = benchmark.setup(random.Random(args.seed), size)
+        started = time.perf_counter_ns()
+        run()
+        timings.append((time.perf_counter_ns() - started) / size)
+
+    # Allocations are counted in a separate run: tracemalloc slows everything down
+    run = benchmark.setup(random.Random(args.seed), size)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        run()
+        current, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    retained_blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+
+    return {
+        "name": benchmark.name,
+        "size": size,
+        "ns_per_op": {"median": round(statistics.median(timings), 1), "min": round(min(timings), 1),
+                      "max": round(max(timings), 1)},
+        "peak_bytes_per_op": round((peak - start_bytes) / size, 1),
+        "retained_bytes_per_op": round((current - start_bytes) / size, 1),
+        "retained_blocks_per_op": round(retained_blocks / size, 3),
+    }
+
+def result_key(result):
+    return f"{result['name']}[{result['size']}]"
+
+#Results whose median time or peak memory per message grew by more than
+#`tolerance` against the baseline; returns (key, metric, baseline, now) tuples.
+def regressions(results, baseline, tolerance):
+    previous = {result_key(result): result for result in baseline.get("results", [])}
+    found = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        for metric, now, then in (("ns_per_op", result["ns_per_op"]["median"], old["ns_per_op"]["median"]),
+                                  ("peak_bytes_per_op", result["peak_bytes_per_op"], old["peak_bytes_per_op"])):
+            # Tiny values are noise: only judge costs of at least a few units
+            if then > 1 and now > then * (1 + tolerance):
+                found.append((result_key(result), metric, then, now))
+    return found
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the parsing, auth and aggregation hot paths.')
+    parser.add_argument('--filter', default='', help='Only run benchmarks whose name contains this text')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='Workload generator seed (default: %(default)s)')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help='Timed runs per benchmark (default: %(default)s)')
+    parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP, help='Untimed runs first (default: %(default)s)')
+    parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+    parser.add_argument('--baseline', help='Compare against a report written earlier with --output')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Allowed growth in per-message cost against the baseline (default: %(default)s)')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    # Rejected and malformed lines are logged by the code under test; keep that quiet
+    setup_logging("error", stream=sys.stderr)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "seed": args.seed,
+        "repeats": args.repeats,
+        "results": [],
+    }
+    for benchmark in BENCHMARKS:
+        if args.filter not in benchmark.name:
+            continue
+        for size in benchmark.sizes:
+            result = measure(benchmark, size, args)
+            print(f"{result_key(result):42} {result['ns_per_op']['median']:>12.1f} ns/op "
+                  f"{result['peak_bytes_per_op']:>10.1f} B/op peak", file=sys.stderr)
+            report["results"].append(result)
+
+    status = 0
+    if args.baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as handle:
+                found = regressions(report["results"], json.load(handle), args.tolerance)
+            report["regressions"] = [{"benchmark": key, "metric": metric, "baseline": then, "now": now}
+                                     for key, metric, then, now in found]
+            for key, metric, then, now in found:
+                print(f"Regression: {key} {metric} {then} -> {now}", file=sys.stderr)
+            status = 1 if found else 0
+        else:
+            print(f"No baseline at {args.baseline}; nothing to compare.", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as handle:
+            handle.write(output + "\n")
+    else:
+        print(output)
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
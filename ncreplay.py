@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# Plays a wire log recorded with --record back into the code that processed
+# it, with no hub or network involved: bot logs go through ncbot's line
+# handling or ircbot's dispatch, controller logs through reply routing and
+# the result summaries. Frames are replayed at the recorded pace (scaled by
+# --speed) or, with --speed 0, as fast as possible, and the run ends with a
+# JSON line of throughput figures.
+import argparse
+import json
+import sys
+import time
+
+import ircbot
+import ncbot
+import nccontrolller
+from botauth import AUTH_V1, AUTH_VERSIONS, authenticator_for, tag_version
+from botcore import Command, CommandGuard, command_text
+from botlog import LEVELS, setup_logging
+from framing import decode_command, split_messages
+from ircproto import IrcParser
+from nonce_store import NonceStore, DEFAULT_WINDOW
+from sendqueue import SendQueue, TokenBucket
+from wirelog import IN, OUT, read_frames
+
+
+#Yields frames at `speed` times the pace they were recorded at; 0 means no waiting.
+def paced(frames, speed):
+    if not frames or not speed:
+        yield from frames
+        return
+    first = frames[0].time_ns
+    started = time.perf_counter()
+    for frame in frames:
+        delay = started + (frame.time_ns - first) / 1e9 / speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        yield frame
+
+#A nonce window wide enough to accept the oldest command in the log.
+def replay_window(frames):
+    if not frames:
+        return DEFAULT_WINDOW
+    return int(time.time() - frames[0].time_ns / 1e9) + DEFAULT_WINDOW
+
+#One ncbot.BotSession per recorded connection, fed everything the bot received.
+def replay_ncbot(frames, args):
+    window = replay_window(frames)
+    sessions = {}
+    stats = {"lines": 0, "commands": 0, "reply_bytes": 0}
+    for frame in paced(frames, args.speed):
+        if frame.direction != IN:
+            continue
+        session = sessions.get(frame.stream)
+        if session is None:
+            session = sessions[frame.stream] = ncbot.BotSession(
+                "replay", 0, args.nick, args.secret, NonceStore(window=window), args.auth)
+        lines = session.reader.feed(frame.data)
+        stats["lines"] += len(lines)
+        for line in lines:
+            # As in the bot, a move or shutdown ends the batch it arrived in
+            if not session.handle_line(line):
+                break
+        # Nothing leaves the process: replies are counted, actions dropped
+        stats["reply_bytes"] += len(session.outbox)
+        session.outbox.clear()
+        session.attacks.clear()
+        session.closing = False
+        session.move_target = None
+    stats["commands"] = sum(session.command_count for session in sessions.values())
+    return stats
+
+
+# Stands in for ircbot's server socket: replies are counted, not sent
+class ReplaySink:
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, data):
+        self.sent += len(data)
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def fileno(self):
+        return -1
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+#Feeds everything the IRC bot received into its parser and dispatch. Attacks,
+#moves and shutdowns only send their report instead of touching the network
+#or ending the process.
+def replay_ircbot(frames, args):
+    sink = ReplaySink()
+    ircbot.server = sink
+    ircbot.channel = args.channel
+    ircbot.nick = args.nick
+    ircbot.secret = args.secret
+    ircbot.auth_version = args.auth
+    ircbot.seen_nonces = NonceStore(window=replay_window(frames))
+    ircbot.guard = CommandGuard(authenticator_for(args.secret), args.auth, ircbot.seen_nonces)
+    ircbot.irc_parser = ircbot.IrcParser()
+    # Replies are not held back by flood control during a replay
+    ircbot.outbound = SendQueue(TokenBucket(interval=0))
+    ircbot.perform_attack = lambda host, port, nick, nonce: ircbot.send_to_channel(
+        f"{ircbot.report_prefix('attack', nonce)} {nick} FAIL not performed during replay")
+    ircbot.move_to_new_server = lambda host, port, nonce=None: ircbot.send_to_channel(
+        f"{ircbot.report_prefix('move', nonce)} {ircbot.nick}")
+    ircbot.shutdown_bot = lambda nonce=None: ircbot.send_to_channel(
+        f"{ircbot.report_prefix('shutdown', nonce)} {ircbot.nick}")
+
+    messages = 0
+    for frame in paced(frames, args.speed):
+        if frame.direction != IN:
+            continue
+        ircbot.irc_parser.feed(frame.data)
+        messages += len(ircbot.irc_parser.messages)
+        ircbot.dispatch_messages()
+        ircbot.flush_outbound()
+    return {"messages": messages, "commands": ircbot.command_count, "reply_bytes": sink.sent}
+
+#Signed commands the controller sent, as (nonce, mac, command): lines and frames
+#to the hub, or the text of its PRIVMSGs over IRC, where `buffer` is an IrcParser.
+def sent_commands(buffer, data):
+    if isinstance(buffer, IrcParser):
+        buffer.feed(data)
+        lines = [message.trailing for message in buffer.messages if message.command == "PRIVMSG" and message.trailing]
+        buffer.messages.clear()
+    else:
+        buffer += data
+        lines = split_messages(buffer, decode_command)
+    commands = []
+    for line in lines:
+        if isinstance(line, Command):
+            commands.append((line.nonce, line.mac, command_text(line)))
+        else:
+            parts = line.split(maxsplit=2)
+            if len(parts) == 3:
+                commands.append(tuple(parts))
+    return commands
+
+#Rebuilds the controller's commands from what it sent and routes what it received.
+def replay_controller(frames, args):
+    pending = {}
+    commands = []
+    # Per recorded connection: one for each hub the controller talked to
+    transports = {}
+    sent = {}
+    lines = 0
+    # Commands sent back to back with the same text are its per-scheme copies
+    last = None
+    for frame in paced(frames, args.speed):
+        transport = transports.get(frame.stream)
+        if transport is None:
+            if args.irc:
+                transport = transports[frame.stream] = nccontrolller.IrcTransport(ReplaySink(), args.channel)
+                sent[frame.stream] = IrcParser()
+            else:
+                transport = transports[frame.stream] = nccontrolller.NcTransport(ReplaySink())
+                sent[frame.stream] = bytearray()
+        if frame.direction == OUT:
+            for nonce, mac, command in sent_commands(sent[frame.stream], frame.data):
+                if nonce in pending:
+                    # The same signed line sent to another hub
+                    continue
+                if last is None or last.command != command:
+                    last = nccontrolller.PendingCommand(command, nonce)
+                    commands.append(last)
+                last.versions[nonce] = tag_version(mac) or AUTH_V1
+                pending[nonce] = last
+        else:
+            last = None
+            for report in transport.feed(frame.data):
+                lines += 1
+                nccontrolller.route_report(pending, *report, hub=frame.stream)
+
+    if not args.quiet:
+        for command in commands:
+            print(f"\n[{command.command}]")
+            command.aggregator.summary()
+    return {"commands": len(commands), "lines": lines,
+            "replies": sum(len(command.responses) for command in commands)}
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Replay a wire log recorded with --record, without a hub.')
+    parser.add_argument('log', help='Wire log file')
+    parser.add_argument('--target', choices=['ncbot', 'ircbot', 'controller'], required=True,
+                        help='Which program recorded the log')
+    parser.add_argument('--secret', default='', help='Secret the recorded commands were signed with (bots)')
+    parser.add_argument('--auth', choices=AUTH_VERSIONS, default=AUTH_V1, help='Auth scheme of the recorded bot')
+    parser.add_argument('--nick', default='replayBot', help='Nick the replayed bot reports under')
+    parser.add_argument('--channel', default='#replay', help='Channel the replayed IRC bot or controller used')
+    parser.add_argument('--irc', action='store_true', help='The controller log was recorded with --irc')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='Multiple of the recorded pace; 0 replays as fast as possible (default: %(default)s)')
+    parser.add_argument('--quiet', action='store_true', help='Skip the controller result summaries')
+    parser.add_argument('--log-level', choices=LEVELS, default='warning',
+                        help='Log level of the replayed code (default: %(default)s)')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    setup_logging(args.log_level, stream=sys.stderr)
+    frames = list(read_frames(args.log))
+    replay = {"ncbot": replay_ncbot, "ircbot": replay_ircbot, "controller": replay_controller}[args.target]
+
+    started = time.perf_counter()
+    stats = replay(frames, args)
+    elapsed = time.perf_counter() - started
+
+    stats.update({
+        "target": args.target,
+        "frames": len(frames),
+        "bytes": sum(len(frame.data) for frame in frames),
+        "seconds": round(elapsed, 6),
+        "frames_per_second": round(len(frames) / elapsed, 1) if elapsed else None,
+    })
+    print(json.dumps(stats))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# Replay protection shared by ncbot.py and ircbot.py, and the nonce
+# generator used by nccontrolller.py.
+#
+# Nonces start with the Unix time they were issued at. A nonce is accepted
+# once, and only while that time is within `window` seconds of our clock.
+# Seen nonces are kept in a ring of time buckets, so expiring old entries
+# means clearing whole buckets instead of rescanning everything we stored.
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+
+DEFAULT_WINDOW = 300
+DEFAULT_BUCKETS = 60
+DEFAULT_CAPACITY = 65536
+
+# Persistent file layout: header, then a ring of fixed-size records
+FILE_MAGIC = b"NONC"
+FILE_VERSION = 1
+HEADER = struct.Struct("<4sIII")   # magic, version, capacity, next record
+RECORD = struct.Struct("<q16s")    # nonce timestamp, nonce digest
+
+LEADING_DIGITS = re.compile(r"\d+")
+
+
+#Returns the issue time (whole seconds) carried at the front of a nonce, or None.
+def nonce_timestamp(nonce):
+    match = LEADING_DIGITS.match(nonce)
+    return int(match.group()) if match else None
+
+#Nonces are stored as 16-byte digests so every entry has the same small size.
+def nonce_digest(nonce):
+    return hashlib.blake2b(nonce.encode(), digest_size=16).digest()
+
+
+# Issues nonces of the form "<seconds>.<microseconds>-<instance>". The time
+# part never repeats or goes backwards within a process, even when several
+# threads send at once or the clock steps back, and the random instance tag
+# keeps separate controller processes apart.
+class NonceGenerator:
+    __slots__ = ("instance", "last", "lock")
+
+    def __init__(self):
+        self.instance = os.urandom(4).hex()
+        self.last = 0
+        self.lock = threading.Lock()
+
+    def reseed(self):
+        self.instance = os.urandom(4).hex()
+
+    def next(self):
+        with self.lock:
+            stamp = max(time.time_ns() // 1000, self.last + 1)
+            self.last = stamp
+        seconds, micros = divmod(stamp, 1_000_000)
+        return f"{seconds}.{micros:06d}-{self.instance}"
+
+
+default_generator = NonceGenerator()
+# A forked child must not share its parent's instance tag
+os.register_at_fork(after_in_child=default_generator.reseed)
+
+def generate_nonce():
+    return default_generator.next()
+
+
+class NonceStore:
+    __slots__ = ("window", "slot_width", "buckets", "bucket_slots", "swept", "file")
+
+    def __init__(self, window=DEFAULT_WINDOW, buckets=DEFAULT_BUCKETS, path=None, capacity=DEFAULT_CAPACITY):
+        self.window = window
+        self.slot_width = max(1, -(-window // buckets))
+        # Accepted timestamps span [now - window, now + window]; two spare
+        # buckets keep the newest slot from landing on one still in use.
+        count = 2 * buckets + 2
+        # Sets are created on first use, so idle stores stay small
+        self.buckets = [None] * count
+        self.bucket_slots = [None] * count
+        self.swept = None
+        self.file = None
+        if path:
+            self.file = NonceFile(path, capacity)
+            now = int(time.time())
+            for timestamp, digest in self.file.records():
+                if abs(now - timestamp) <= window:
+                    self.insert(timestamp, digest)
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets if bucket)
+
+    #Accepts a nonce the first time it is seen inside the window, rejects it otherwise.
+    def accept(self, nonce, now=None):
+        timestamp = nonce_timestamp(nonce)
+        if timestamp is None:
+            return False
+        now = int(time.time()) if now is None else int(now)
+        if abs(now - timestamp) > self.window:
+            return False
+
+        self.expire(now)
+        digest = nonce_digest(nonce)
+        if not self.insert(timestamp, digest):
+            return False
+        if self.file:
+            self.file.append(timestamp, digest)
+        return True
+
+    def insert(self, timestamp, digest):
+        slot = timestamp // self.slot_width
+        index = slot % len(self.buckets)
+        bucket = self.buckets[index]
+        if self.bucket_slots[index] != slot or bucket is None:
+            # Whatever this bucket held belongs to a slot outside the window
+            bucket = self.buckets[index] = set()
+            self.bucket_slots[index] = slot
+        if digest in bucket:
+            return False
+        bucket.add(digest)
+        return True
+
+    #Clears buckets whose slot fell out of the window. Each slot is swept once.
+    def expire(self, now):
+        oldest = (now - self.window) // self.slot_width
+        if self.swept is None or oldest - self.swept > len(self.buckets):
+            # First call or a long idle period: check every bucket once
+            for index, slot in enumerate(self.bucket_slots):
+                if slot is not None and slot < oldest:
+                    self.buckets[index] = None
+                    self.bucket_slots[index] = None
+            self.swept = oldest
+            return
+
+        while self.swept < oldest:
+            index = self.swept % len(self.buckets)
+            if self.bucket_slots[index] == self.swept:
+                self.buckets[index] = None
+                self.bucket_slots[index] = None
+            self.swept += 1
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+# Fixed-size ring of (timestamp, digest) records in a memory-mapped file.
+# Once full, the oldest records are overwritten, so `capacity` should cover
+# the number of commands expected within one window.
+class NonceFile:
+    __slots__ = ("handle", "map", "capacity", "head")
+
+    def __init__(self, path, capacity=DEFAULT_CAPACITY):
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER.size
+        self.handle = open(path, "r+b" if exists else "w+b")
+
+        if exists:
+            magic, version, stored_capacity, head = HEADER.unpack(self.handle.read(HEADER.size))
+            if magic != FILE_MAGIC or version != FILE_VERSION:
+                self.handle.close()
+                raise ValueError(f"{path} is not a nonce store file")
+            capacity = stored_capacity
+        else:
+            head = 0
+
+        size = HEADER.size + capacity * RECORD.size
+        if os.path.getsize(path) != size:
+            self.handle.truncate(size)
+        self.map = mmap.mmap(self.handle.fileno(), size)
+        self.capacity = capacity
+        self.head = head % capacity
+        HEADER.pack_into(self.map, 0, FILE_MAGIC, FILE_VERSION, capacity, self.head)
+
+    def records(self):
+        for index in range(self.capacity):
+            timestamp, digest = RECORD.unpack_from(self.map, HEADER.size + index * RECORD.size)
+            if timestamp:
+                yield timestamp, digest
+
+    def append(self, timestamp, digest):
+        RECORD.pack_into(self.map, HEADER.size + self.head * RECORD.size, timestamp, digest)
+        self.head = (self.head + 1) % self.capacity
+        HEADER.pack_into(self.map, 0, FILE_MAGIC, FILE_VERSION, self.capacity, self.head)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.handle.close()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Reconnect policy and resolver cache shared by ncbot.py and ircbot.py.
+#
+# A lost connection is retried quickly at first, then with capped exponential
+# backoff. Every delay is drawn uniformly between zero and the current cap
+# ("full jitter"), so a fleet that lost its hub at the same moment does not
+# come back in lockstep. Hostnames are resolved through a small TTL cache
+# instead of a blocking lookup on every attempt.
+import random
+import socket
+import time
+
+
+DEFAULT_INITIAL_DELAY = 0.1
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_MULTIPLIER = 2.0
+DEFAULT_RESOLVER_TTL = 60.0
+# Failed lookups are remembered for less time than successful ones
+DEFAULT_NEGATIVE_TTL = 5.0
+MAX_RESOLVER_ENTRIES = 1024
+
+
+# Backoff settings plus counters for every connection that uses them
+class ReconnectPolicy:
+    __slots__ = ("initial", "maximum", "multiplier", "attempts", "failures", "reconnects",
+                 "reconnect_seconds_total", "reconnect_seconds_max", "reconnect_seconds_last")
+
+    def __init__(self, initial=DEFAULT_INITIAL_DELAY, maximum=DEFAULT_MAX_DELAY, multiplier=DEFAULT_MULTIPLIER):
+        self.initial = initial
+        self.maximum = maximum
+        self.multiplier = multiplier
+        # Connection attempts, failed attempts, and connections restored after a loss
+        self.attempts = 0
+        self.failures = 0
+        self.reconnects = 0
+        self.reconnect_seconds_total = 0.0
+        self.reconnect_seconds_max = 0.0
+        self.reconnect_seconds_last = None
+
+    def backoff(self):
+        return Backoff(self)
+
+    def stats(self):
+        return {
+            "attempts": self.attempts,
+            "failures": self.failures,
+            "reconnects": self.reconnects,
+            "reconnect_seconds_mean": round(self.reconnect_seconds_total / self.reconnects, 3) if self.reconnects else None,
+            "reconnect_seconds_max": round(self.reconnect_seconds_max, 3),
+            "reconnect_seconds_last": None if self.reconnect_seconds_last is None else round(self.reconnect_seconds_last, 3),
+        }
+
+
+# Retry state of one connection
+class Backoff:
+    __slots__ = ("policy", "failures", "down_since")
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.failures = 0
+        # When the connection was lost, or None while it is up
+        self.down_since = None
+
+    def attempt(self):
+        self.policy.attempts += 1
+
+    #Records a failed attempt (or, with failed=False, a lost connection) and
+    #returns the seconds to wait before the next attempt.
+    def next_delay(self, failed=True):
+        policy = self.policy
+        if failed:
+            policy.failures += 1
+        if self.down_since is None:
+            self.down_since = time.monotonic()
+        ceiling = min(policy.maximum, policy.initial * policy.multiplier ** self.failures)
+        self.failures += 1
+        return random.uniform(0, ceiling)
+
+    #Records a successful connection; returns how long it was down, or None for a first connect.
+    def connected(self):
+        down_since, self.down_since, self.failures = self.down_since, None, 0
+        if down_since is None:
+            return None
+        policy = self.policy
+        elapsed = time.monotonic() - down_since
+        policy.reconnects += 1
+        policy.reconnect_seconds_total += elapsed
+        policy.reconnect_seconds_max = max(policy.reconnect_seconds_max, elapsed)
+        policy.reconnect_seconds_last = elapsed
+        return elapsed
+
+
+# (hostname, port) -> IPv4 socket address, kept for `ttl` seconds
+class Resolver:
+    __slots__ = ("ttl", "negative_ttl", "entries", "hits", "misses")
+
+    def __init__(self, ttl=DEFAULT_RESOLVER_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    #Returns a socket address for hostname:port, or None if the name does not resolve.
+    def resolve(self, hostname, port):
+        key = (hostname, int(port))
+        now = time.monotonic()
+        entry = self.entries.get(key)
+        if entry and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        try:
+            address = socket.getaddrinfo(hostname, int(port), socket.AF_INET, socket.SOCK_STREAM)[0][4]
+            expires = now + self.ttl
+        except (socket.gaierror, IndexError):
+            address = None
+            expires = now + self.negative_ttl
+        if len(self.entries) >= MAX_RESOLVER_ENTRIES:
+            self.entries.clear()
+        self.entries[key] = (expires, address)
+        return address
+
+    def stats(self):
+        return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+def add_reconnect_arguments(parser):
+    parser.add_argument('--reconnect-initial', type=float, default=DEFAULT_INITIAL_DELAY,
+                        help='Longest wait in seconds before the first reconnect attempt (default: %(default)s)')
+    parser.add_argument('--reconnect-max', type=float, default=DEFAULT_MAX_DELAY,
+                        help='Cap on the wait between reconnect attempts in seconds (default: %(default)s)')
+    parser.add_argument('--reconnect-multiplier', type=float, default=DEFAULT_MULTIPLIER,
+                        help='Growth of the wait after each failed attempt (default: %(default)s)')
+    parser.add_argument('--resolver-ttl', type=float, default=DEFAULT_RESOLVER_TTL,
+                        help='Seconds a resolved hostname is reused; 0 looks it up every time (default: %(default)s)')
+
+def policy_from_args(args):
+    return ReconnectPolicy(args.reconnect_initial, args.reconnect_max, args.reconnect_multiplier)
+
+def resolver_from_args(args):
+    return Resolver(args.resolver_ttl, min(args.resolver_ttl, DEFAULT_NEGATIVE_TTL))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# Outbound line queue with flood control, used by ircbot.py.
+#
+# Lines are queued instead of written straight to the socket, and the owner's
+# select loop drains the queue whenever the socket is writable. A token bucket
+# admits lines at the rate IRC servers tolerate (RFC 1459 allows a burst of
+# about five lines, then one every two seconds), so a channel full of bots
+# answering at once is not kicked for flooding. Admitted lines can be
+# coalesced into one write, and partial sends resume where they stopped.
+import time
+from collections import deque
+
+
+DEFAULT_BURST = 5
+DEFAULT_INTERVAL = 2.0
+
+
+# `burst` lines may go out back to back, then one more every `interval` seconds.
+# An interval of 0 turns the limit off.
+class TokenBucket:
+    __slots__ = ("burst", "interval", "tokens", "updated")
+
+    def __init__(self, burst=DEFAULT_BURST, interval=DEFAULT_INTERVAL):
+        self.burst = max(1, burst)
+        self.interval = interval
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.interval:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) / self.interval)
+        else:
+            self.tokens = self.burst
+        self.updated = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    #Seconds until the next line may be admitted.
+    def wait(self, now):
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) * self.interval)
+
+
+class SendQueue:
+    __slots__ = ("bucket", "coalesce", "lines", "buffer", "lines_sent", "writes")
+
+    def __init__(self, bucket=None, coalesce=True):
+        self.bucket = bucket or TokenBucket()
+        self.coalesce = coalesce
+        # Lines waiting for a token, then the bytes admitted but not yet written
+        self.lines = deque()
+        self.buffer = bytearray()
+        self.lines_sent = 0
+        self.writes = 0
+
+    #Queues a line; urgent ones (heartbeat pings) go ahead of those already waiting.
+    def put(self, data, urgent=False):
+        if urgent:
+            self.lines.appendleft(data)
+        else:
+            self.lines.append(data)
+
+    def clear(self):
+        self.lines.clear()
+        self.buffer.clear()
+
+    def __len__(self):
+        return len(self.lines)
+
+    #Whether anything is admitted and waiting for the socket to become writable.
+    def wants_write(self):
+        return bool(self.buffer)
+
+    #Seconds until the queue can make progress without a writable event, or None if it is idle.
+    def timeout(self):
+        if self.buffer or not self.lines:
+            return None
+        return self.bucket.wait(time.monotonic())
+
+    def admit(self):
+        now = time.monotonic()
+        while self.lines and (self.coalesce or not self.buffer):
+            if not self.bucket.take(now):
+                break
+            self.buffer += self.lines.popleft()
+            self.lines_sent += 1
+
+    #Writes as much as the socket takes right now and returns the bytes written.
+    #`send` is called with a memoryview and returns the count it wrote (0 if it would block).
+    def flush(self, send):
+        written = 0
+        while True:
+            if not self.buffer:
+                self.admit()
+                if not self.buffer:
+                    return written
+            with memoryview(self.buffer) as view:
+                sent = send(view)
+            self.writes += 1
+            if not sent:
+                return written
+            del self.buffer[:sent]
+            written += sent
+
+    def stats(self):
+        return {"queued_lines": len(self.lines), "buffered_bytes": len(self.buffer),
+                "lines_sent": self.lines_sent, "writes": self.writes}
+
+
+def add_flood_arguments(parser):
+    parser.add_argument('--send-burst', type=int, default=DEFAULT_BURST,
+                        help='Lines that may be sent back to back before flood control applies (default: %(default)s)')
+    parser.add_argument('--send-interval', type=float, default=DEFAULT_INTERVAL,
+                        help='Seconds between lines once the burst is used up; 0 disables flood control (default: %(default)s)')
+    parser.add_argument('--no-coalesce', dest='coalesce', action='store_false',
+                        help='Write each queued line separately instead of joining them into one write')
+
+def queue_from_args(args):
+    return SendQueue(TokenBucket(args.send_burst, args.send_interval), args.coalesce)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# Wire-traffic log shared by ncbot.py, ircbot.py and nccontrolller.py, read
+# back by ncreplay.py.
+#
+# A log is a short header followed by one frame per send or receive:
+# timestamp (ns since the epoch), direction, stream id (the socket's file
+# descriptor, so interleaved connections can be told apart), payload length,
+# then the payload bytes exactly as they went over the socket. Frames go
+# through a write buffer, so recording costs a struct pack and a memory copy
+# per send or receive. The buffer is written out once it fills, on the first
+# frame after FLUSH_INTERVAL, at exit and on SIGTERM, so a killed process
+# keeps the traffic that led up to it.
+import atexit
+import signal
+import struct
+import threading
+import time
+from collections import namedtuple
+
+
+MAGIC = b"WIRE"
+VERSION = 1
+HEADER = struct.Struct("<4sI")     # magic, version
+FRAME = struct.Struct("<qBII")     # time ns, direction, stream, length
+IN = 0
+OUT = 1
+WRITE_BUFFER = 1 << 16
+FLUSH_INTERVAL_NS = 1_000_000_000
+
+Frame = namedtuple("Frame", ["time_ns", "direction", "stream", "data"])
+
+# The active recorder, or None while recording is off
+recorder = None
+
+
+class WireRecorder:
+    __slots__ = ("handle", "flushed_ns")
+
+    def __init__(self, path):
+        self.handle = open(path, "wb", buffering=WRITE_BUFFER)
+        self.handle.write(HEADER.pack(MAGIC, VERSION))
+        self.flushed_ns = time.time_ns()
+
+    def record(self, direction, data, stream=0):
+        now = time.time_ns()
+        self.handle.write(FRAME.pack(now, direction, stream, len(data)))
+        self.handle.write(data)
+        if now - self.flushed_ns >= FLUSH_INTERVAL_NS:
+            self.handle.flush()
+            self.flushed_ns = now
+
+    def close(self):
+        self.handle.close()
+
+
+#Starts appending every send and receive to `path` until the process exits.
+def start_recording(path):
+    global recorder
+    stop_recording()
+    recorder = WireRecorder(path)
+    # atexit does not run when SIGTERM kills the process; leave handlers set by the program alone
+    if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+        signal.signal(signal.SIGTERM, terminated)
+
+#Writes out the log and exits as SIGTERM asked, running the usual cleanup on the way.
+def terminated(signum, frame):
+    stop_recording()
+    raise SystemExit(128 + signum)
+
+def stop_recording():
+    global recorder
+    if recorder:
+        recorder.close()
+        recorder = None
+
+atexit.register(stop_recording)
+
+def read_frames(path):
+    with open(path, "rb") as handle:
+        magic, version = HEADER.unpack(handle.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a wire log")
+        while True:
+            header = handle.read(FRAME.size)
+            if len(header) < FRAME.size:
+                return
+            time_ns, direction, stream, length = FRAME.unpack(header)
+            data = handle.read(length)
+            if len(data) < length:
+                # The writer was cut off mid-frame
+                return
+            yield Frame(time_ns, direction, stream, data)
+
+def add_recording_arguments(parser):
+    parser.add_argument('--record', metavar='FILE', help='Record all socket traffic to a wire log that ncreplay.py can play back')